@@ -167,6 +167,8 @@ class CocoDataset(Dataset):
         results["bbox_fields"] = []
         results["mask_fields"] = []
         results["seg_fields"] = []
+        # identifies the image for the training target cache
+        results["img_id"] = results["img_info"].get("id")
 
     def _filter_imgs(self, min_size=32):
         """Filter images too small or without ground truths."""
@@ -14,6 +14,7 @@ from .piplines import (
     RandomFlip,
     MultiScaleFlipAug,
     ImageToTensor,
+    SOLOv2Target,
 )
 
 
@@ -29,6 +30,7 @@ process_funcs_dict = {
     "RandomFlip": RandomFlip,
     "MultiScaleFlipAug": MultiScaleFlipAug,
     "ImageToTensor": ImageToTensor,
+    "SOLOv2Target": SOLOv2Target,
 }
 
 COLORS = (
@@ -410,6 +412,14 @@ coco_base_config = Config(
 
 # ----------------------- SOLO v2.0 CONFIGS ----------------------- #
 
+# grid assignment of SOLOv2Head, shared by the head and the SOLOv2Target
+# transform building its targets in the loader workers
+solov2_grid_cfg = dict(
+    num_grids=[40, 36, 24, 16, 12],
+    scale_ranges=((1, 56), (28, 112), (56, 224), (112, 448), (224, 896)),
+    sigma=0.2,
+)
+
 solov2_base_config = coco_base_config.copy(
     {
         "name": "solov2_base",
@@ -448,10 +458,23 @@ solov2_base_config = coco_base_config.copy(
             dict(
                 type="Pad", size_divisor=32
             ),  # pad另一边的size为32的倍数，solov2对网络输入的尺寸有要求，图像的size需要为32的倍数
+            # grid targets are built in the loader workers
+            dict(type="SOLOv2Target", **solov2_grid_cfg),
             dict(type="DefaultFormatBundle"),  # 将数据转换为tensor，为后续网络计算
             dict(
                 type="Collect",
-                keys=["img", "gt_bboxes", "gt_labels", "gt_masks"],
+                keys=[
+                    "img",
+                    "gt_bboxes",
+                    "gt_labels",
+                    "ins_labels",
+                    "cate_labels",
+                    "ins_ind_labels",
+                    "grid_orders",
+                    "ins_indices",
+                    "gt_centers",
+                    "gt_areas",
+                ],
                 meta_keys=(
                     "filename",
                     "ori_shape",
@@ -460,10 +483,33 @@ solov2_base_config = coco_base_config.copy(
                     "scale_factor",
                     "flip",
                     "img_norm_cfg",
+                    "img_id",
+                    "scale_idx",
+                    "grid_fingerprint",
                 ),
             ),
         ],
         "test_cfg": None,
+        # num_grids, scale_ranges and sigma of the head; a train_pipeline
+        # with SOLOv2Target must be built from the same values
+        "grid_cfg": solov2_grid_cfg,
+        # directory of the on-disk training target cache, None disables it;
+        # only for a train_pipeline without SOLOv2Target, which already builds
+        # the targets in the loader workers
+        "target_cache_dir": None,
+        # memory bound of the instance loss: at most max_ins_per_img positive
+        # masks per image (sampled uniformly), computed ins_loss_chunk at a time
+        "max_ins_per_img": None,
+        "ins_loss_chunk": None,
+        # evaluate solo_kernel only at the positive cells (train) or at the
+        # cells passing score_thr (test) instead of over every grid
+        "sparse_kernel": False,
+        # loss_cate over the positive cells and this many hardness-sampled
+        # negative cells per image, None keeps every cell
+        "cate_neg_per_img": None,
+        # at inference, add the CoordConv coordinate channels as a bias cached
+        # per feature size instead of concatenating them to the features
+        "fold_coord_conv": False,
         # learning policy
         "lr_config": dict(
             policy="step",
@@ -502,11 +548,36 @@ solov2_base_config = coco_base_config.copy(
         "test_cfg": dict(
             nms_pre=500,
             score_thr=0.1,
+            # at most this many candidates per image go through the dynamic
+            # convolution, the best by category score, None keeps all
+            max_kernels_before_conv=None,
+            # compute the candidate masks this many kernels per image at a
+            # time and keep only the masks left after the nms_pre cut, None
+            # computes all of them at once
+            mask_chunk=None,
             mask_thr=0.5,
             update_thr=0.05,
             kernel="gaussian",  # gaussian/linear
             sigma=2.0,
             max_per_img=30,
+            # "dense": bool masks at the original size, "lazy": LazySegMasks
+            # that upsample an instance on first access, "cropped":
+            # CroppedSegMasks resampled only inside the instance boxes,
+            # "band": the "dense" masks resampled only along the boundaries
+            mask_format="dense",
+            # Matrix NMS over blocks of this many candidates, bounding its
+            # memory to nms_pre x nms_block_size, None computes it at once
+            nms_block_size=None,
+            # Matrix NMS within the candidates of every class, same result
+            nms_per_class=False,
+            # run the category branch first and, when no cell of the batch
+            # passes score_thr, return None for every image without running
+            # the kernel branch and the mask feature head
+            cate_first=False,
+            # indices of the pyramid levels (grids 40, 36, 24, 16, 12) to run,
+            # e.g. (2, 3, 4) for medium and large objects only; the other
+            # levels are skipped in the head and get_seg. None runs all
+            levels=None,
         ),
     }
 )
@@ -16,6 +16,12 @@ from .imgutils import (
     impad,
     impad_to_multiple,
 )
+from modules.solov2_target import (
+    grid_fingerprint,
+    mass_centers,
+    rescale_masks,
+    solov2_assign_grids,
+)
 
 
 class LoadImageFromFile(object):
@@ -469,6 +475,70 @@ class Pad(object):
         return repr_str
 
 
+class SOLOv2Target(object):
+    """Generate the SOLOv2 training targets of an image.
+
+    Runs the grid assignment of ``SOLOv2Head`` in the data loader workers, so
+    the full resolution masks do not have to be sent to the main process.
+    Must come after ``Pad``, the grids divide the padded image. The head
+    reassigns the grids from ``gt_centers`` when the batch is padded to a
+    larger size than this image.
+
+    Added keys are "ins_labels" (stride-4 masks, one per instance),
+    "cate_labels", "ins_ind_labels", "grid_orders" and "ins_indices" (one
+    entry per level), "gt_centers" and "gt_areas" (mass centers and pixel
+    counts of the masks) and "grid_fingerprint" (``grid_fingerprint`` of the
+    settings below, to collect into the meta). The head assigns the grids
+    again when the fingerprint does not match its own settings.
+
+    Args:
+        num_grids (list[int]): grid number of every level.
+        scale_ranges (list[tuple]): instance scale range of every level.
+        sigma (float): center region scale.
+        output_stride (int): stride of the mask features.
+    """
+
+    def __init__(self, num_grids, scale_ranges, sigma, output_stride=4):
+        self.num_grids = list(num_grids)
+        self.scale_ranges = scale_ranges
+        self.sigma = sigma
+        self.output_stride = output_stride
+        self.fingerprint = grid_fingerprint(num_grids, scale_ranges, sigma)
+
+    def __call__(self, results):
+        gt_masks = results["gt_masks"]
+        gt_labels = torch.from_numpy(results["gt_labels"])
+        centers, areas = mass_centers(gt_masks)
+        level_targets = solov2_assign_grids(
+            torch.from_numpy(results["gt_bboxes"]),
+            gt_labels,
+            torch.from_numpy(centers),
+            torch.from_numpy(areas > 0),
+            results["pad_shape"][:2],
+            self.num_grids,
+            self.scale_ranges,
+            self.sigma,
+        )
+        (
+            results["cate_labels"],
+            results["ins_ind_labels"],
+            results["grid_orders"],
+            results["ins_indices"],
+        ) = (list(level_target) for level_target in zip(*level_targets))
+        results["ins_labels"] = rescale_masks(gt_masks, 1.0 / self.output_stride)
+        results["gt_centers"] = centers
+        results["gt_areas"] = areas
+        results["grid_fingerprint"] = self.fingerprint
+        return results
+
+    def __repr__(self):
+        repr_str = self.__class__.__name__
+        repr_str += "(num_grids={}, scale_ranges={}, sigma={})".format(
+            self.num_grids, self.scale_ranges, self.sigma
+        )
+        return repr_str
+
+
 def to_tensor(data):
     """Convert objects of various python types to :obj:`torch.Tensor`.
 
@@ -601,6 +671,9 @@ class DefaultFormatBundle(object):
     - gt_bboxes_ignore: (1)to tensor, (2)to DataContainer
     - gt_labels: (1)to tensor, (2)to DataContainer
     - gt_masks: (1)to tensor, (2)to DataContainer (cpu_only=True)
+    - ins_labels, gt_centers, gt_areas: (1)to tensor, (2)to DataContainer
+    - cate_labels, ins_ind_labels, grid_orders, ins_indices: (1)to
+      DataContainer, they are already lists of tensors
     """
 
     def __call__(self, results):
@@ -631,6 +704,14 @@ class DefaultFormatBundle(object):
         if "gt_masks" in results:
             results["gt_masks"] = DC(results["gt_masks"], cpu_only=True)
             # results['gt_masks'] = results['gt_masks']
+        for key in ["ins_labels", "gt_centers", "gt_areas"]:
+            if key not in results:
+                continue
+            results[key] = DC(to_tensor(results[key]))
+        for key in ["cate_labels", "ins_ind_labels", "grid_orders", "ins_indices"]:
+            if key not in results:
+                continue
+            results[key] = DC(results[key])
         return results
 
     def _add_default_meta_keys(self, results):
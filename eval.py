@@ -2,17 +2,16 @@ from data.config import cfg, process_funcs_dict
 from data.coco import CocoDataset
 from data.loader import build_dataloader
 from modules.solov2 import SOLOV2
+from modules.rle import encode_masks
 import torch.optim as optim
 import time
 import argparse
 import torch
 from torch.nn.utils import clip_grad
-import pycocotools.mask as mask_util
 import numpy as np
 import cv2 as cv
 from data.compose import Compose
 from glob import glob
-import pycocotools.mask as maskutil
 import json
 import os
 from scipy import ndimage
@@ -283,14 +282,12 @@ def get_masks(result, num_classes=80):
         masks = [[] for _ in range(num_classes)]
         if cur_result is None:
             return masks
-        seg_pred = cur_result[0].cpu().numpy().astype(np.uint8)
+        rles = encode_masks(cur_result[0])
         cate_label = cur_result[1].cpu().numpy().astype(np.int)
         cate_score = cur_result[2].cpu().numpy().astype(np.float)
-        num_ins = seg_pred.shape[0]
+        num_ins = len(rles)
         for idx in range(num_ins):
-            cur_mask = seg_pred[idx, ...]
-            rle = mask_util.encode(np.array(cur_mask[:, :, np.newaxis], order="F"))[0]
-            rst = (rle, cate_score[idx])
+            rst = (rles[idx], cate_score[idx])
             masks[cate_label[idx]].append(rst)
 
         return masks
@@ -317,10 +314,10 @@ def build_process_pipeline(pipeline_confg):
 
 def result2json(img_id, result):
     rel = []
-    seg_pred = result[0][0].cpu().numpy().astype(np.uint8)
+    rles = encode_masks(result[0][0])
     cate_label = result[0][1].cpu().numpy().astype(np.int)
     cate_score = result[0][2].cpu().numpy().astype(np.float)
-    num_ins = seg_pred.shape[0]
+    num_ins = len(rles)
     for j in range(num_ins):
         realclass = COCO_LABEL[cate_label[j]]
         re = {}
@@ -328,10 +325,7 @@ def result2json(img_id, result):
         re["image_id"] = img_id
         re["category_id"] = int(realclass)
         re["score"] = float(score)
-        outmask = np.squeeze(seg_pred[j])
-        outmask = outmask.astype(np.uint8)
-        outmask = np.asfortranarray(outmask)
-        rle = maskutil.encode(outmask)
+        rle = rles[j]
         rle["counts"] = rle["counts"].decode("ascii")
         re["segmentation"] = rle
         rel.append(re)
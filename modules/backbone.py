@@ -158,8 +158,11 @@ class ResNet(nn.Module):
         width_per_group=64,
         replace_stride_with_dilation=None,
         norm_layer=None,
+        frozen_stages=1,
     ):
         super(ResNet, self).__init__()
+        # -1: nothing frozen, 0: the stem, i: the stem and layer1 ... layer{i}
+        self.frozen_stages = frozen_stages
         if norm_layer is None:
             norm_layer = nn.BatchNorm2d
         self._norm_layer = norm_layer
@@ -213,11 +216,12 @@ class ResNet(nn.Module):
                     nn.init.constant_(m.bn2.weight, 0)
 
     def _freeze_stages(self):
-        self.bn1.eval()
-        for m in [self.conv1, self.bn1]:
-            for param in m.parameters():
-                param.requires_grad = False
-        for i in range(1, 1 + 1):
+        if self.frozen_stages >= 0:
+            self.bn1.eval()
+            for m in [self.conv1, self.bn1]:
+                for param in m.parameters():
+                    param.requires_grad = False
+        for i in range(1, self.frozen_stages + 1):
             m = getattr(self, "layer{}".format(i))
             m.eval()
             for param in m.parameters():
@@ -267,22 +271,23 @@ class ResNet(nn.Module):
     def _forward_impl(self, x):
         # See note [TorchScript super()]
 
-        x = self.conv1(x)
+        # frozen stages need no gradient, so their activations are not kept
+        # for backward; the first trainable stage starts from a leaf tensor
+        with torch.set_grad_enabled(self.frozen_stages < 0 and torch.is_grad_enabled()):
+            x = self.conv1(x)
 
-        x = self.bn1(x)
-        x = self.relu(x)
-        x = self.maxpool(x)
+            x = self.bn1(x)
+            x = self.relu(x)
+            x = self.maxpool(x)
 
         outs = []
-        x = self.layer1(x)
-
-        outs.append(x)
-        x = self.layer2(x)
-        outs.append(x)
-        x = self.layer3(x)
-        outs.append(x)
-        x = self.layer4(x)
-        outs.append(x)
+        for i in range(1, 5):
+            layer = getattr(self, "layer{}".format(i))
+            with torch.set_grad_enabled(
+                self.frozen_stages < i and torch.is_grad_enabled()
+            ):
+                x = layer(x)
+            outs.append(x)
         # print("outs", outs[0].shape, outs[1].shape, outs[2].shape, outs[3].shape)
         return tuple(outs)
 
@@ -0,0 +1,80 @@
+import torch
+import torch.nn.functional as F
+
+
+def coord_feat(num, height, width, device=None):
+    """The x and y coordinate channels, in [-1, 1], that CoordConv appends to
+    the features.
+
+    Returns:
+        Tensor: shape (num, 2, height, width).
+    """
+    x_range = torch.linspace(-1, 1, width, device=device)
+    y_range = torch.linspace(-1, 1, height, device=device)
+    y, x = torch.meshgrid(y_range, x_range)
+    y = y.expand([num, 1, -1, -1])
+    x = x.expand([num, 1, -1, -1])
+    return torch.cat([x, y], 1)
+
+
+class CoordBias(object):
+    """First conv of a CoordConv branch with the coordinates as a bias.
+
+    The conv is linear, so its output on ``cat([feat, coords])`` is the conv
+    of ``feat`` with the feature part of the weight plus the conv of the
+    coordinates with the last two input channels. The second term only
+    depends on the feature size (and the grid size the coordinates are
+    resized to), it is computed once per size and kept as long as the
+    weight is not changed, which also saves building and concatenating the
+    coordinates on every call.
+
+    The kept tensors are not tracked by autograd, this is meant for
+    inference.
+    """
+
+    def __init__(self):
+        self._key = None
+        self._weight = None
+        self._biases = {}
+
+    def __call__(self, conv, feat, coord_size, grid_size=None):
+        """Output of ``conv`` on the features with coordinates appended.
+
+        Args:
+            conv (nn.Conv2d): conv over the features and two coordinate
+                channels.
+            feat (Tensor): features without coordinates, shape (N, C, h, w).
+            coord_size (tuple[int]): (height, width) the coordinates are
+                built at.
+            grid_size (int | None): size the features and coordinates were
+                resized to, None when they are not.
+
+        Returns:
+            Tensor: same as ``conv(torch.cat([feat, coords], 1))``.
+        """
+        weight = conv.weight.detach()
+        key = (weight.data_ptr(), weight._version, weight.device, weight.dtype)
+        if key != self._key:
+            self._key = key
+            self._weight = weight[:, :-2].contiguous()
+            self._biases = {}
+        size_key = (tuple(coord_size), grid_size)
+        if size_key not in self._biases:
+            coords = coord_feat(1, *coord_size, device=weight.device).to(weight.dtype)
+            if grid_size is not None:
+                coords = F.interpolate(
+                    coords, size=grid_size, mode="bilinear", align_corners=False
+                )
+            bias = conv.bias.detach() if conv.bias is not None else None
+            self._biases[size_key] = F.conv2d(
+                coords,
+                weight[:, -2:].contiguous(),
+                bias,
+                conv.stride,
+                conv.padding,
+                conv.dilation,
+            )
+        out = F.conv2d(
+            feat, self._weight, None, conv.stride, conv.padding, conv.dilation
+        )
+        return out.add_(self._biases[size_key])
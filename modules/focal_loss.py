@@ -1,9 +1,80 @@
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.autograd import Function
+from torch.autograd.function import once_differentiable
 
-# from modules.sigmoid_focal_loss import sigmoid_focal_loss as _sigmoid_focal_loss
 from .utils import weight_reduce_loss
 
+try:
+    # built by `python setup.py develop` when CUDA is available
+    from .sigmoid_focal_loss import sigmoid_focal_loss as _sigmoid_focal_loss_cuda
+except ImportError:
+    _sigmoid_focal_loss_cuda = None
+
+
+class FusedSigmoidFocalLossFunction(Function):
+    """Summed sigmoid focal loss of ``pred`` (N, C) and labels ``target`` (N).
+
+    Label 0 is background, label ``c`` is positive for column ``c - 1``, same
+    as the CUDA extension. ``weight`` (N) optionally scales the loss of every
+    row, as ``weight.view(-1, 1)`` does in ``sigmoid_focal_loss``; it gets no
+    gradient. Only the inputs are kept for backward, the gradient is
+    computed in closed form instead of through ``pt``, the focal weight and
+    the BCE term, and without a one-hot target.
+    """
+
+    @staticmethod
+    def forward(ctx, pred, target, weight=None, gamma=2.0, alpha=0.25):
+        ctx.save_for_backward(pred, target, weight)
+        ctx.gamma = gamma
+        ctx.alpha = alpha
+        # every entry as a negative, then the positive entries corrected
+        neg_loss = pred.clone().sigmoid_().pow_(gamma).mul_(F.logsigmoid(-pred))
+        if weight is None:
+            loss = neg_loss.sum() * -(1 - alpha)
+        else:
+            loss = torch.dot(neg_loss.sum(1), weight) * -(1 - alpha)
+        pos_inds = (target > 0).nonzero().flatten()
+        if len(pos_inds) > 0:
+            pos_pred = pred[pos_inds, target[pos_inds] - 1]
+            pos_sigmoid = pos_pred.sigmoid()
+            pos_loss = (1 - alpha) * pos_sigmoid.pow(gamma) * F.logsigmoid(
+                -pos_pred
+            ) - alpha * (1 - pos_sigmoid).pow(gamma) * F.logsigmoid(pos_pred)
+            if weight is not None:
+                pos_loss = pos_loss * weight[pos_inds]
+            loss = loss + pos_loss.sum()
+        return loss
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, d_loss):
+        pred, target, weight = ctx.saved_tensors
+        gamma = ctx.gamma
+        alpha = ctx.alpha
+        # negatives: (1 - alpha) * p^gamma * (p - gamma * (1 - p) * log(1 - p))
+        pred_sigmoid = pred.clone().sigmoid_()
+        d_pred = F.logsigmoid(-pred).mul_(1 - pred_sigmoid).mul_(-gamma)
+        d_pred.add_(pred_sigmoid).mul_(pred_sigmoid.pow_(gamma)).mul_(1 - alpha)
+        # positives: alpha * (1 - p)^gamma * (gamma * p * log(p) - (1 - p))
+        pos_inds = (target > 0).nonzero().flatten()
+        if len(pos_inds) > 0:
+            pos_cols = target[pos_inds] - 1
+            pos_pred = pred[pos_inds, pos_cols]
+            pos_sigmoid = pos_pred.sigmoid()
+            d_pred[pos_inds, pos_cols] = (
+                alpha
+                * (1 - pos_sigmoid).pow(gamma)
+                * (gamma * pos_sigmoid * F.logsigmoid(pos_pred) - (1 - pos_sigmoid))
+            )
+        if weight is not None:
+            d_pred.mul_(weight.view(-1, 1))
+        return d_pred.mul_(d_loss), None, None, None, None
+
+
+fused_sigmoid_focal_loss = FusedSigmoidFocalLossFunction.apply
+
 
 def py_sigmoid_focal_loss(
     pred, target, weight=None, gamma=2.0, alpha=0.25, reduction="mean", avg_factor=None
@@ -23,9 +94,23 @@ def py_sigmoid_focal_loss(
 def sigmoid_focal_loss(
     pred, target, weight=None, gamma=2.0, alpha=0.25, reduction="mean", avg_factor=None
 ):
-    # Function.apply does not accept keyword arguments, so the decorator
-    # "weighted_loss" is not applicable
-    loss = _sigmoid_focal_loss(pred, target, gamma, alpha)
+    if pred.is_cuda and _sigmoid_focal_loss_cuda is not None:
+        # Function.apply does not accept keyword arguments, so the decorator
+        # "weighted_loss" is not applicable
+        loss = _sigmoid_focal_loss_cuda(pred, target, gamma, alpha)
+    elif reduction != "none":
+        # no element-wise loss is needed, reduce inside the fused function
+        loss = fused_sigmoid_focal_loss(pred, target, weight, gamma, alpha)
+        if reduction == "mean":
+            loss = loss / (pred.numel() if avg_factor is None else avg_factor)
+        return loss
+    else:
+        one_hot = F.one_hot(target.long(), pred.size(1) + 1)[:, 1:]
+        if weight is not None:
+            weight = weight.view(-1, 1)
+        return py_sigmoid_focal_loss(
+            pred, one_hot, weight, gamma, alpha, reduction, avg_factor
+        )
 
     # TODO: find a proper way to handle the shape of weight
     if weight is not None:
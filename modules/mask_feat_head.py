@@ -3,6 +3,7 @@ import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
 from .nninit import xavier_init, kaiming_init, normal_init, bias_init_with_prob
+from .coord_conv import CoordBias, coord_feat
 
 
 class MaskFeatHead(nn.Module):
@@ -14,8 +15,9 @@ class MaskFeatHead(nn.Module):
         end_level,  # 3
         num_classes,  # 128
         conv_cfg=None,  # None
-        norm_cfg=None,
-    ):  # dict(type='GN', num_groups=32, requires_grad=True)),
+        norm_cfg=None,  # dict(type='GN', num_groups=32, requires_grad=True)),
+        fold_coord_conv=False,  # coordinates as a cached bias at inference
+    ):
         super(MaskFeatHead, self).__init__()
 
         self.in_channels = in_channels
@@ -26,6 +28,7 @@ class MaskFeatHead(nn.Module):
         self.num_classes = num_classes
         self.conv_cfg = conv_cfg
         self.norm_cfg = norm_cfg
+        self.coord_bias = CoordBias() if fold_coord_conv else None
 
         self.convs_all_levels = nn.ModuleList()
         for i in range(self.start_level, self.end_level + 1):
@@ -89,23 +92,26 @@ class MaskFeatHead(nn.Module):
         feature_add_all_level = self.convs_all_levels[0](inputs[0])
         for i in range(1, len(inputs)):
             input_p = inputs[i]
-            if i == 3:
-                input_feat = input_p
-                x_range = torch.linspace(
-                    -1, 1, input_feat.shape[-1], device=input_feat.device
+            if i == 3 and self.coord_bias is not None and not self.training:
+                # the coordinates enter the first conv as a bias
+                level_convs = self.convs_all_levels[i]
+                level_feat = level_convs[0][1:](
+                    self.coord_bias(level_convs[0][0], input_p, input_p.shape[-2:])
                 )
-                y_range = torch.linspace(
-                    -1, 1, input_feat.shape[-2], device=input_feat.device
-                )
-                y, x = torch.meshgrid(y_range, x_range)
-                y = y.expand([input_feat.shape[0], 1, -1, -1])
-                x = x.expand([input_feat.shape[0], 1, -1, -1])
-                coord_feat = torch.cat([x, y], 1)
-                input_p = torch.cat([input_p, coord_feat], 1)
+                level_feat = level_convs[1:](level_feat)
+            else:
+                if i == 3:
+                    input_feat = input_p
+                    coord = coord_feat(
+                        input_feat.shape[0],
+                        input_feat.shape[-2],
+                        input_feat.shape[-1],
+                        device=input_feat.device,
+                    )
+                    input_p = torch.cat([input_p, coord], 1)
+                level_feat = self.convs_all_levels[i](input_p)
 
-            feature_add_all_level = feature_add_all_level + self.convs_all_levels[i](
-                input_p
-            )
+            feature_add_all_level = feature_add_all_level + level_feat
 
         feature_pred = self.conv_pred(feature_add_all_level)
         return feature_pred
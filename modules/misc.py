@@ -55,6 +55,168 @@ def matrix_nms(seg_masks, cate_labels, cate_scores, kernel='gaussian', sigma=2.0
     cate_scores_update = cate_scores * decay_coefficient
     return cate_scores_update
 
+def matrix_nms_tiled(seg_masks, cate_labels, cate_scores, kernel='gaussian', sigma=2.0, sum_masks=None, block_size=256):
+    """Matrix NMS computed ``block_size`` candidates at a time.
+
+    Gives the same scores as ``matrix_nms`` without its n x n matrices. The
+    candidates are processed in column blocks: the decay IoUs of a block
+    against all earlier candidates, at most n x block_size, give the
+    compensation IoU of the block and, with the compensation of the earlier
+    blocks, the minimum decay. The rows after a block have no IoU with it and
+    only contribute ``f(0) / f(compensate_iou)``, taken as a suffix minimum at
+    the end. The masks stay in their input dtype (bool or uint8) and are
+    converted to float one block at a time for the intersections.
+
+    Args:
+        seg_masks (Tensor): shape (n, h, w)
+        cate_labels (Tensor): shape (n), mask labels in descending order
+        cate_scores (Tensor): shape (n), mask scores in descending order
+        kernel (str):  'linear' or 'gauss' 
+        sigma (float): std in gaussian method
+        sum_masks (Tensor): The sum of seg_masks
+        block_size (int): candidates per block
+
+    Returns:
+        Tensor: cate_scores_update, tensors of shape (n)
+    """
+    n_samples = len(cate_labels)
+    if n_samples == 0:
+        return []
+    if sum_masks is None:
+        sum_masks = seg_masks.sum((1, 2)).float()
+    seg_masks = seg_masks.reshape(n_samples, -1)
+    if kernel == 'gaussian':
+        decay_func = lambda iou: torch.exp(-1 * sigma * (iou ** 2))
+    elif kernel == 'linear':
+        decay_func = lambda iou: 1 - iou
+    else:
+        raise NotImplementedError
+
+    blocks = [(start, min(start + block_size, n_samples)) for start in range(0, n_samples, block_size)]
+    compensate_iou = sum_masks.new_zeros(n_samples)
+    decay_coefficient = sum_masks.new_empty(n_samples)
+    inds = torch.arange(n_samples, device=cate_labels.device)
+    for col_start, col_end in blocks:
+        col_masks = seg_masks[col_start:col_end].float().transpose(1, 0)
+        decay_iou = []
+        for row_start, row_end in blocks:
+            if row_start >= col_end:
+                break
+            # inter.
+            inter_matrix = torch.mm(seg_masks[row_start:row_end].float(), col_masks)
+            # union, same operand order as matrix_nms.
+            union_matrix = (sum_masks[col_start:col_end].unsqueeze(0)
+                            + sum_masks[row_start:row_end].unsqueeze(1)
+                            - inter_matrix)
+            # iou of the same-label pairs above the diagonal.
+            upper = inds[row_start:row_end].unsqueeze(1) < inds[col_start:col_end]
+            same_label = (cate_labels[row_start:row_end].unsqueeze(1)
+                          == cate_labels[col_start:col_end].unsqueeze(0))
+            decay_iou.append((inter_matrix / union_matrix) * (upper & same_label).float())
+        decay_iou = torch.cat(decay_iou, 0)
+        compensate_iou[col_start:col_end], _ = decay_iou.max(0)
+        decay_matrix = decay_func(decay_iou) / decay_func(compensate_iou[:col_end]).unsqueeze(1)
+        decay_coefficient[col_start:col_end], _ = decay_matrix.min(0)
+
+    # the rows after every block.
+    tail = decay_func(torch.zeros_like(compensate_iou)) / decay_func(compensate_iou)
+    tail = tail.flip(0).cummin(0)[0].flip(0)
+    for col_start, col_end in blocks[:-1]:
+        decay_coefficient[col_start:col_end] = torch.min(
+            decay_coefficient[col_start:col_end], tail[col_end:col_end + 1])
+
+    # update the score.
+    cate_scores_update = cate_scores * decay_coefficient
+    return cate_scores_update
+
+def matrix_nms_sparse(seg_masks, cate_labels, cate_scores, kernel='gaussian', sigma=2.0, sum_masks=None):
+    """Matrix NMS computed within the candidates of every class.
+
+    Gives the same scores as ``matrix_nms``, whose IoUs between candidates of
+    different classes are computed and then zeroed. Here every class block
+    runs the dense computation on its own candidates. Only pairs whose mask
+    boxes overlap get intersections, over the union box of those masks. The
+    candidates of the other classes only contribute
+    ``f(0) / f(compensate_iou)`` to the minimum decay, taken once per class.
+    The cost follows the sum of the squared class sizes instead of n^2.
+
+    Args:
+        seg_masks (Tensor): shape (n, h, w)
+        cate_labels (Tensor): shape (n), mask labels in descending order
+        cate_scores (Tensor): shape (n), mask scores in descending order
+        kernel (str):  'linear' or 'gauss' 
+        sigma (float): std in gaussian method
+        sum_masks (Tensor): The sum of seg_masks
+
+    Returns:
+        Tensor: cate_scores_update, tensors of shape (n)
+    """
+    n_samples = len(cate_labels)
+    if n_samples == 0:
+        return []
+    if sum_masks is None:
+        sum_masks = seg_masks.sum((1, 2)).float()
+    if kernel == 'gaussian':
+        decay_func = lambda iou: torch.exp(-1 * sigma * (iou ** 2))
+    elif kernel == 'linear':
+        decay_func = lambda iou: 1 - iou
+    else:
+        raise NotImplementedError
+
+    h, w = seg_masks.shape[-2:]
+    # sorted by class, then by score order.
+    order = torch.argsort(cate_labels * n_samples + torch.arange(n_samples, device=cate_labels.device))
+    counts = torch.unique_consecutive(cate_labels[order], return_counts=True)[1]
+
+    # mask boxes.
+    rows = seg_masks.any(2)
+    cols = seg_masks.any(1)
+    row_inds = torch.arange(h, device=rows.device)
+    col_inds = torch.arange(w, device=cols.device)
+    boxes = torch.stack([
+        torch.where(rows, row_inds, row_inds.new_tensor(h)).min(1)[0],
+        torch.where(rows, row_inds, row_inds.new_tensor(-1)).max(1)[0],
+        torch.where(cols, col_inds, col_inds.new_tensor(w)).min(1)[0],
+        torch.where(cols, col_inds, col_inds.new_tensor(-1)).max(1)[0]], 1)
+
+    decay_coefficient = sum_masks.new_empty(n_samples)
+    group_min = []
+    for inds in order.split(counts.tolist()):
+        n_group = len(inds)
+        box = boxes[inds]
+        overlap = ((box[:, None, 0] <= box[None, :, 1]) & (box[None, :, 0] <= box[:, None, 1])
+                   & (box[:, None, 2] <= box[None, :, 3]) & (box[None, :, 2] <= box[:, None, 3])).triu(diagonal=1)
+        decay_iou = sum_masks.new_zeros((n_group, n_group))
+        if overlap.any():
+            # inter, over the union box of the overlapping masks.
+            involved = (overlap.any(0) | overlap.any(1)).nonzero().flatten()
+            y0, x0 = int(box[involved, 0].min()), int(box[involved, 2].min())
+            y1, x1 = int(box[involved, 1].max()) + 1, int(box[involved, 3].max()) + 1
+            masks = seg_masks[inds[involved], y0:y1, x0:x1].reshape(len(involved), -1).float()
+            inter_matrix = torch.mm(masks, masks.transpose(1, 0))
+            # union, same operand order as matrix_nms.
+            sums = sum_masks[inds[involved]]
+            sum_masks_x = sums.expand(len(involved), len(involved))
+            union_matrix = sum_masks_x + sum_masks_x.transpose(1, 0) - inter_matrix
+            iou_matrix = inter_matrix / union_matrix
+            pair = overlap[involved][:, involved]
+            decay_iou[involved[:, None], involved[None, :]] = iou_matrix * pair.float()
+        compensate_iou, _ = decay_iou.max(0)
+        decay_matrix = decay_func(decay_iou) / decay_func(compensate_iou).unsqueeze(-1)
+        decay_coefficient[inds], _ = decay_matrix.min(0)
+        group_min.append((decay_func(torch.zeros_like(compensate_iou)) / decay_func(compensate_iou)).min())
+
+    # the candidates of the other classes.
+    group_min = torch.stack(group_min)
+    others = ~torch.eye(len(group_min), dtype=torch.bool, device=group_min.device)
+    other_min = torch.where(others, group_min.expand(len(group_min), len(group_min)),
+                            group_min.new_tensor(float('inf'))).min(1)[0]
+    decay_coefficient[order] = torch.min(decay_coefficient[order], other_min.repeat_interleave(counts))
+
+    # update the score.
+    cate_scores_update = cate_scores * decay_coefficient
+    return cate_scores_update
+
 def multi_apply(func, *args, **kwargs):
     """Apply function to a list of arguments.
 
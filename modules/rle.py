@@ -0,0 +1,287 @@
+import numpy as np
+
+from .seg_masks import (
+    CroppedSegMasks,
+    LazySegMasks,
+    block_tiles,
+    cell_states,
+    mask_transform,
+    support_blocks,
+)
+
+
+def encode_masks(masks, chunk=16, refine=True):
+    """COCO compressed RLEs of instance masks, same bytes as
+    ``pycocotools.mask.encode``.
+
+    The run boundaries of the column-major masks are found for ``chunk``
+    masks at a time, and the counts strings of all masks are written at
+    once. A ``CroppedSegMasks`` is encoded from its crops and a
+    ``LazySegMasks`` from its low resolution masks (see ``lazy_toggles``),
+    neither creates full size masks.
+
+    Args:
+        masks (Tensor | LazySegMasks | CroppedSegMasks): bool masks of shape
+            (n, h, w).
+        chunk (int): masks per step of the dense and lazy boundary search.
+        refine (bool): for a ``LazySegMasks``, evaluate the upsampling on
+            the pixels near mask boundaries. False only rescales the low
+            resolution runs.
+
+    Returns:
+        list[dict]: per mask ``{"size": [h, w], "counts": bytes}``.
+    """
+    num_masks, h, w = masks.shape
+    if isinstance(masks, CroppedSegMasks):
+        toggles = [
+            crop_toggles(crop, offset, (h, w))
+            for crop, offset in zip(masks.crops, masks.offsets.tolist())
+        ]
+    elif isinstance(masks, LazySegMasks):
+        toggles = lazy_toggles(masks, refine, chunk)
+    else:
+        toggles = []
+        for start in range(0, num_masks, chunk):
+            toggles.extend(dense_toggles(masks[start : start + chunk]))
+    return [
+        dict(size=[h, w], counts=counts) for counts in counts_strings(toggles, h * w)
+    ]
+
+
+def dense_toggles(masks):
+    """Column-major positions where every mask changes value.
+
+    The masks are compared in their row-major layout, every pixel against
+    the one above it and the first row against the last row of the previous
+    column, which are its predecessors in column-major order. Only the
+    changes found are reordered, instead of transposing the masks.
+
+    Args:
+        masks (Tensor): shape (n, h, w).
+
+    Returns:
+        list[ndarray]: per mask, increasing positions.
+    """
+    num_masks, h, w = masks.shape
+    masks = masks.bool().cpu().numpy()
+    change = np.empty(masks.shape, dtype=bool)
+    np.not_equal(masks[:, 1:], masks[:, :-1], out=change[:, 1:])
+    np.not_equal(masks[:, 0, 1:], masks[:, -1, :-1], out=change[:, 0, 1:])
+    change[:, 0, 0] = masks[:, 0, 0]
+    inds = np.flatnonzero(change)
+    mask_inds, pixels = np.divmod(inds, h * w)
+    rows, cols = np.divmod(pixels, w)
+    keys = np.sort(inds - pixels + cols * h + rows)
+    return np.split(
+        keys - mask_inds * (h * w), np.searchsorted(mask_inds, np.arange(1, num_masks))
+    )
+
+
+def crop_toggles(crop, offset, shape):
+    """Column-major positions where a mask given as a crop changes value.
+
+    Args:
+        crop (Tensor): bool mask of the box, shape (h, w).
+        offset (tuple[int]): (y, x) of the box.
+        shape (tuple[int]): (h, w) of the full mask.
+
+    Returns:
+        ndarray: increasing positions.
+    """
+    crop = crop.cpu().numpy()
+    if crop.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    y, x = offset
+    height, width = shape
+    # zero rows around the crop, changes are found inside every column
+    padded = np.zeros((crop.shape[0] + 2, crop.shape[1]), dtype=bool)
+    padded[1:-1] = crop
+    rows, cols = np.nonzero(padded[1:] != padded[:-1])
+    positions = (cols + x) * height + rows + y
+    # a run leaving at the bottom and one entering at the top of the next
+    # column meet when the crop spans the full height
+    positions, counts = np.unique(positions, return_counts=True)
+    # leaving at the last pixel is the end of the mask, not a change
+    return positions[(counts % 2 == 1) & (positions < height * width)]
+
+
+def lazy_toggles(masks, refine=True, chunk=16):
+    """Column-major positions where the full resolution masks of a
+    ``LazySegMasks`` change value, without upsampling them.
+
+    The upsampling is separable, every output row (column) is a weighted sum
+    of a few consecutive input rows (columns), its support. Consecutive
+    output rows with the same support form a row block and the same goes for
+    columns. A cell of a row and a column block is certain when the soft
+    masks are on one side of ``mask_thr`` over its whole support, bilinear
+    weights are convex so all its pixels are on that side as well. Certain
+    cells give their changes from the block grid, scaled to the block sizes.
+    The remaining cells lie on the mask boundaries: ``refine`` evaluates the
+    upsampled values of their pixels, which matches ``LazySegMasks.upsample``
+    up to float rounding at ``mask_thr``. Otherwise a cell takes the value
+    of its center pixel, which only changes pixels of the cells whose
+    support crosses the thresholded low resolution boundary.
+
+    Args:
+        masks (LazySegMasks): masks to encode.
+        refine (bool): evaluate the pixels of uncertain cells.
+        chunk (int): masks per step.
+
+    Returns:
+        list[ndarray]: per mask, increasing positions.
+    """
+    num_masks, low_h, low_w = masks.soft_masks.shape
+    h, w = masks.ori_shape[:2]
+    weights_y = mask_transform(low_h, masks.upsampled_size[0], masks.img_shape[0], h)
+    weights_x = mask_transform(low_w, masks.upsampled_size[1], masks.img_shape[1], w)
+    row_support = support_blocks(weights_y)
+    col_support = support_blocks(weights_x)
+    # the tiles of the row blocks start one row above the block
+    tile_rows, row_tiles = block_tiles(weights_y, row_support[0], 1)
+    tile_cols, col_tiles = block_tiles(weights_x, col_support[0], 0)
+    row_starts, tile_rows, row_tiles = [
+        t.numpy() for t in (row_support[0], tile_rows, row_tiles)
+    ]
+    col_starts, tile_cols, col_tiles = [
+        t.numpy() for t in (col_support[0], tile_cols, col_tiles)
+    ]
+    heights = np.diff(row_starts)
+    widths = np.diff(col_starts)
+    toggles = []
+    for start in range(0, num_masks, chunk):
+        soft_masks = masks.soft_masks[start : start + chunk].float().cpu()
+        # 0 and 1 for certain cells, 2 for cells on a boundary
+        states = cell_states(
+            soft_masks > masks.mask_thr, *row_support[1:], *col_support[1:]
+        ).numpy()
+        soft_masks = soft_masks.numpy()
+        num_chunk = len(soft_masks)
+
+        cell_inds, cell_rows, cell_cols = np.nonzero(states == 2)
+        padded = np.zeros((num_chunk, len(heights) + 2, len(widths)), dtype=np.int8)
+        padded[:, 1:-1] = states
+        if len(cell_inds):
+            # upsampled values of the pixels of every uncertain cell
+            size_y, size_x = row_tiles.shape[2], col_tiles.shape[2]
+            soft_padded = np.zeros(
+                (num_chunk, low_h + size_y, low_w + size_x), dtype=np.float32
+            )
+            soft_padded[:, :low_h, :low_w] = soft_masks
+            patches = soft_padded[
+                cell_inds[:, None, None],
+                tile_rows[cell_rows][:, None, None] + np.arange(size_y)[:, None],
+                tile_cols[cell_cols][:, None, None] + np.arange(size_x),
+            ]
+            tiles = (
+                row_tiles[cell_rows] @ patches @ col_tiles[cell_cols].transpose(0, 2, 1)
+            ) > masks.mask_thr
+            if refine:
+                # every pixel against the one above it, and the first pixel
+                # below the cell when that one is certain
+                last = heights[cell_rows] + (
+                    padded[cell_inds, cell_rows + 2, cell_cols] != 2
+                )
+                cells, cell_ys, cell_xs = np.nonzero(
+                    (tiles[:, 1:] != tiles[:, :-1])
+                    & (np.arange(tiles.shape[1] - 1)[:, None] < last[:, None, None])
+                    & (np.arange(tiles.shape[2]) < widths[cell_cols][:, None, None])
+                )
+                refined_inds = cell_inds[cells]
+                refined = (
+                    (col_starts[cell_cols[cells]] + cell_xs) * h
+                    + row_starts[cell_rows[cells]]
+                    + cell_ys
+                )
+            else:
+                padded[cell_inds, cell_rows + 1, cell_cols] = tiles[
+                    np.arange(len(cell_inds)),
+                    1 + heights[cell_rows] // 2,
+                    widths[cell_cols] // 2,
+                ]
+
+        # changes between vertically adjacent certain cells, zero above and
+        # below every column, repeated for all columns of the column block
+        above, below = padded[:, :-1], padded[:, 1:]
+        mask_inds, blocks, col_blocks = np.nonzero(
+            (above != below) & (above != 2) & (below != 2)
+        )
+        repeats = widths[col_blocks]
+        mask_inds = np.repeat(mask_inds, repeats)
+        cols = np.repeat(col_starts[col_blocks], repeats) + _aranges(repeats)
+        positions = cols * h + np.repeat(row_starts[blocks], repeats)
+        if refine and len(cell_inds):
+            mask_inds = np.concatenate([mask_inds, refined_inds])
+            positions = np.concatenate([positions, refined])
+        toggles.extend(_merge_toggles(mask_inds, positions, num_chunk, h * w))
+    return toggles
+
+
+def _merge_toggles(mask_inds, positions, num_masks, num_pixels):
+    """Per mask sorted positions, dropping positions given twice and the end
+    of the mask.
+
+    A column ending inside a mask and the next one starting inside it give
+    the same position twice, which is no change.
+    """
+    keys, key_counts = np.unique(
+        mask_inds * (num_pixels + 1) + positions, return_counts=True
+    )
+    mask_inds, positions = np.divmod(keys[key_counts % 2 == 1], num_pixels + 1)
+    keep = positions < num_pixels
+    mask_inds, positions = mask_inds[keep], positions[keep]
+    return np.split(positions, np.searchsorted(mask_inds, np.arange(1, num_masks)))
+
+
+def _aranges(sizes):
+    """Concatenated ``np.arange`` of every size."""
+    return np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+
+
+def counts_strings(toggles, num_pixels):
+    """COCO compressed counts of masks given by their change positions.
+
+    Counts alternate between runs of zeros and ones starting with zeros.
+    Each count from the third on is stored as the difference to the count
+    two before, in groups of 5 bits with a continuation bit, offset by 48
+    to printable characters (``rleToString`` of the COCO API).
+
+    Args:
+        toggles (list[ndarray]): per mask, increasing change positions.
+        num_pixels (int): pixels per mask.
+
+    Returns:
+        list[bytes]: per mask, the counts string.
+    """
+    if len(toggles) == 0:
+        return []
+    num_runs = np.array([len(t) + 1 for t in toggles], dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(num_runs)[:-1]])
+    bounds = np.concatenate(
+        [np.concatenate([[0], t, [num_pixels]]) for t in toggles]
+    ).astype(np.int64)
+    # the boundary list of mask i spans num_runs[i] + 1 entries
+    ends = np.cumsum(num_runs + 1)
+    counts = np.delete(np.diff(bounds), ends[:-1] - 1)
+    # run index within its mask
+    run_inds = np.arange(len(counts)) - np.repeat(starts, num_runs)
+    values = counts.copy()
+    delta = run_inds > 2
+    values[delta] -= counts[np.nonzero(delta)[0] - 2]
+
+    # up to 7 groups of 5 bits, arithmetic shifts keep the sign
+    chars = np.zeros((len(values), 7), dtype=np.uint8)
+    emit = np.zeros((len(values), 7), dtype=bool)
+    more = np.ones(len(values), dtype=bool)
+    x = values
+    for k in range(7):
+        emit[:, k] = more
+        c = x & 0x1F
+        x = x >> 5
+        next_more = np.where(c & 0x10, x != -1, x != 0)
+        chars[:, k] = (c | np.where(next_more, 0x20, 0)) + 48
+        more = more & next_more
+    char_counts = emit.sum(1)
+    data = chars[emit].tobytes()
+    mask_chars = np.add.reduceat(char_counts, starts)
+    offsets = np.concatenate([[0], np.cumsum(mask_chars)])
+    return [data[offsets[i] : offsets[i + 1]] for i in range(len(toggles))]
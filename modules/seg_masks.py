@@ -0,0 +1,381 @@
+import operator
+
+import torch
+import torch.nn.functional as F
+
+
+def resize_matrix(in_size, out_size, device=None):
+    """Weights of a 1-d bilinear resize (align_corners=False), such that
+    ``resize_matrix(n, m) @ x`` resizes the rows of x from n to m.
+
+    Returns:
+        Tensor: shape (out_size, in_size).
+    """
+    eye = torch.eye(in_size, device=device)
+    return F.interpolate(
+        eye[None, None], size=(out_size, in_size), mode="bilinear", align_corners=False
+    )[0, 0]
+
+
+def mask_transform(low_size, upsampled_size, img_size, ori_size, device=None):
+    """Weights of the mask upsampling of ``get_seg`` along one axis: resize
+    from the mask features to the padded input, crop to the image and resize
+    to the original image.
+
+    Returns:
+        Tensor: shape (ori_size, low_size).
+    """
+    upsample = resize_matrix(low_size, upsampled_size, device)[:img_size]
+    return resize_matrix(img_size, ori_size, device) @ upsample
+
+
+def crop_upsample(soft_masks, upsampled_size, img_shape, ori_shape, mask_thr):
+    """Full resolution masks resampled only inside their boxes.
+
+    Bilinear resizing gives convex combinations of the input, so an output
+    pixel can only pass ``mask_thr`` when one of the low resolution pixels it
+    is computed from does. Every instance is resampled on the output rows and
+    columns reached by the box of its low resolution pixels above
+    ``mask_thr``, which costs in proportion to the instance area instead of
+    the image area.
+
+    Args:
+        soft_masks (Tensor): shape (n, h, w), mask probabilities.
+        upsampled_size (tuple[int]): (h, w) of the padded input.
+        img_shape (tuple[int]): shape of the resized image in the input.
+        ori_shape (tuple[int]): shape of the original image.
+        mask_thr (float): mask threshold.
+
+    Returns:
+        tuple: per instance bool crops and their (y, x) offsets in the
+            original image, shape (n, 2).
+    """
+    num_masks, low_h, low_w = soft_masks.shape
+    device = soft_masks.device
+    weights_y = mask_transform(
+        low_h, upsampled_size[0], img_shape[0], ori_shape[0], device
+    )
+    weights_x = mask_transform(
+        low_w, upsampled_size[1], img_shape[1], ori_shape[1], device
+    )
+    fg = soft_masks > mask_thr
+    # foreground in the padding past img_shape reaches no output pixel
+    rows = fg.any(2) & (weights_y > 0).any(0)
+    cols = fg.any(1) & (weights_x > 0).any(0)
+    crops = []
+    offsets = soft_masks.new_zeros((num_masks, 2), dtype=torch.long)
+    for idx in range(num_masks):
+        if not rows[idx].any() or not cols[idx].any():
+            crops.append(fg.new_zeros((0, 0)))
+            continue
+        y0, y1, src_y = _support(weights_y, rows[idx])
+        x0, x1, src_x = _support(weights_x, cols[idx])
+        crop = (
+            weights_y[y0:y1, src_y]
+            @ soft_masks[idx, src_y, src_x]
+            @ weights_x[x0:x1, src_x].t()
+        )
+        crops.append(crop > mask_thr)
+        offsets[idx, 0] = y0
+        offsets[idx, 1] = x0
+    return crops, offsets
+
+
+def band_upsample(soft_masks, upsampled_size, img_shape, ori_shape, mask_thr):
+    """Full resolution masks resampled only along their boundaries.
+
+    The output rows (columns) with the same input support in the resize
+    matrices of ``mask_transform`` form blocks. A cell of a row and a column
+    block whose support is on one side of ``mask_thr`` is on that side as a
+    whole, bilinear weights being convex, and is filled from the stride-4
+    prediction. Only the cells whose support crosses the threshold are
+    resampled, which gives the masks of ``LazySegMasks.upsample`` up to
+    float rounding at ``mask_thr``.
+
+    Args:
+        soft_masks (Tensor): shape (n, h, w), mask probabilities.
+        upsampled_size (tuple[int]): (h, w) of the padded input.
+        img_shape (tuple[int]): shape of the resized image in the input.
+        ori_shape (tuple[int]): shape of the original image.
+        mask_thr (float): mask threshold.
+
+    Returns:
+        Tensor: bool masks of shape (n, H, W).
+    """
+    num_masks, low_h, low_w = soft_masks.shape
+    device = soft_masks.device
+    weights_y = mask_transform(
+        low_h, upsampled_size[0], img_shape[0], ori_shape[0], device
+    )
+    weights_x = mask_transform(
+        low_w, upsampled_size[1], img_shape[1], ori_shape[1], device
+    )
+    row_starts, row_lo, row_hi = support_blocks(weights_y)
+    col_starts, col_lo, col_hi = support_blocks(weights_x)
+    states = cell_states(soft_masks > mask_thr, row_lo, row_hi, col_lo, col_hi)
+
+    # every pixel takes the state of its cell
+    heights = row_starts[1:] - row_starts[:-1]
+    widths = col_starts[1:] - col_starts[:-1]
+    row_cells = torch.arange(len(heights), device=device).repeat_interleave(heights)
+    col_cells = torch.arange(len(widths), device=device).repeat_interleave(widths)
+    # columns first, the rows are then copied whole
+    masks = (states == 1).index_select(2, col_cells).index_select(1, row_cells)
+
+    cell_inds, cell_rows, cell_cols = (states == 2).nonzero().t()
+    if len(cell_inds) == 0:
+        return masks
+    tile_rows, row_tiles = block_tiles(weights_y, row_starts)
+    tile_cols, col_tiles = block_tiles(weights_x, col_starts)
+    size_y, size_x = row_tiles.size(2), col_tiles.size(2)
+    padded = soft_masks.new_zeros((num_masks, low_h + size_y, low_w + size_x))
+    padded[:, :low_h, :low_w] = soft_masks
+    offsets_y = torch.arange(size_y, device=device).view(-1, 1)
+    offsets_x = torch.arange(size_x, device=device)
+    patches = padded[
+        cell_inds.view(-1, 1, 1),
+        tile_rows[cell_rows].view(-1, 1, 1) + offsets_y,
+        tile_cols[cell_cols].view(-1, 1, 1) + offsets_x,
+    ]
+    tiles = (
+        row_tiles[cell_rows] @ patches @ col_tiles[cell_cols].transpose(1, 2)
+    ) > mask_thr
+    tile_ys = torch.arange(row_tiles.size(1), device=device).view(-1, 1)
+    tile_xs = torch.arange(col_tiles.size(1), device=device)
+    inside = (tile_ys < heights[cell_rows].view(-1, 1, 1)) & (
+        tile_xs < widths[cell_cols].view(-1, 1, 1)
+    )
+    cells, ys, xs = inside.nonzero().t()
+    masks[
+        cell_inds[cells],
+        row_starts[cell_rows[cells]] + ys,
+        col_starts[cell_cols[cells]] + xs,
+    ] = tiles[inside]
+    return masks
+
+
+def support_blocks(weights):
+    """Runs of output indices of a resize matrix with the same input support.
+
+    Returns:
+        tuple(Tensor): the starts of the runs followed by the output size, and
+            the first and end input index of every support.
+    """
+    nonzero = (weights > 0).int()
+    lo = (nonzero.cumsum(1) == 0).sum(1)
+    hi = weights.size(1) - (nonzero.flip(1).cumsum(1) == 0).sum(1)
+    new = torch.ones_like(lo, dtype=torch.bool)
+    new[1:] = (lo[1:] != lo[:-1]) | (hi[1:] != hi[:-1])
+    starts = new.nonzero().flatten()
+    return torch.cat([starts, starts.new_tensor([len(lo)])]), lo[starts], hi[starts]
+
+
+def block_tiles(weights, starts, extend=0):
+    """Weights of the output indices of every block of a resize matrix on one
+    window of inputs per block.
+
+    Args:
+        weights (Tensor): resize matrix, shape (out, in).
+        starts (Tensor): block starts followed by the output size.
+        extend (int): output indices added on both sides of every block.
+
+    Returns:
+        tuple(Tensor): first input index of every window, shape (r), and the
+            weights, shape (r, size, window), zero past the block and outside
+            the output.
+    """
+    out_size, in_size = weights.shape
+    nonzero = (weights > 0).int()
+    lo = (nonzero.cumsum(1) == 0).sum(1)
+    hi = in_size - (nonzero.flip(1).cumsum(1) == 0).sum(1)
+    size = int((starts[1:] - starts[:-1]).max()) + 2 * extend
+    inds = (starts[:-1] - extend).view(-1, 1) + torch.arange(
+        size, device=weights.device
+    )
+    valid = (inds >= 0) & (inds < out_size) & (inds < starts[1:].view(-1, 1) + extend)
+    inds = inds.clamp(0, out_size - 1)
+    window_lo = torch.where(valid, lo[inds], lo.new_full((), in_size)).min(1)[0]
+    window_hi = torch.where(valid, hi[inds], hi.new_zeros(())).max(1)[0]
+    window = int((window_hi - window_lo).max())
+    padded = weights.new_zeros((out_size, in_size + window))
+    padded[:, :in_size] = weights
+    tiles = padded[
+        inds.unsqueeze(2),
+        window_lo.view(-1, 1, 1) + torch.arange(window, device=weights.device),
+    ]
+    return window_lo, tiles * valid.unsqueeze(2)
+
+
+def cell_states(fg, row_lo, row_hi, col_lo, col_hi):
+    """State of every cell of row and column supports: 0 and 1 when the
+    foreground is empty or full over the support of the cell, 2 otherwise.
+
+    Args:
+        fg (Tensor): bool masks, shape (n, h, w).
+        row_lo, row_hi (Tensor): row supports, shape (r).
+        col_lo, col_hi (Tensor): column supports, shape (c).
+
+    Returns:
+        Tensor: int8 states, shape (n, r, c).
+    """
+    num_masks, h, w = fg.shape
+    # foreground count of every cell support from the integral image
+    integral = fg.new_zeros((num_masks, h + 1, w + 1), dtype=torch.int32)
+    integral[:, 1:, 1:] = fg.int().cumsum(1).cumsum(2)
+    col_sums = integral.index_select(2, col_hi) - integral.index_select(2, col_lo)
+    counts = col_sums.index_select(1, row_hi) - col_sums.index_select(1, row_lo)
+    areas = (row_hi - row_lo).view(-1, 1) * (col_hi - col_lo)
+    states = (counts > 0).to(torch.int8) * (1 + (counts < areas).to(torch.int8))
+    return states
+
+
+def _support(weights, fg):
+    """Output range reached by the foreground span of ``fg`` and the input
+    slice it is computed from."""
+    fg_inds = fg.nonzero().flatten()
+    lo, hi = int(fg_inds[0]), int(fg_inds[-1]) + 1
+    out_inds = (weights[:, lo:hi] > 0).any(1).nonzero().flatten()
+    out_lo, out_hi = int(out_inds[0]), int(out_inds[-1]) + 1
+    in_inds = (weights[out_lo:out_hi] > 0).any(0).nonzero().flatten()
+    return out_lo, out_hi, slice(int(in_inds[0]), int(in_inds[-1]) + 1)
+
+
+class LazySegMasks(object):
+    """Instance masks of one image kept at the stride of the mask features.
+
+    ``get_seg`` returns this instead of the full resolution masks when the
+    test config sets ``mask_format="lazy"``. It holds the soft masks at mask
+    feature resolution and the transform to the original image: upsample to
+    ``upsampled_size`` (the padded input), crop to ``img_shape``, resize to
+    ``ori_shape`` and threshold at ``mask_thr``. A full resolution mask is
+    only computed when it is accessed, one instance at a time, and is kept
+    afterwards.
+
+    Integer indexing gives the bool mask of one instance, any other index
+    (slice, index or bool tensor) a ``LazySegMasks`` of the selected
+    instances.
+
+    Args:
+        soft_masks (Tensor): shape (n, h, w), mask probabilities.
+        upsampled_size (tuple[int]): (h, w) of the padded input.
+        img_shape (tuple[int]): shape of the resized image in the input.
+        ori_shape (tuple[int]): shape of the original image.
+        mask_thr (float): mask threshold.
+    """
+
+    def __init__(self, soft_masks, upsampled_size, img_shape, ori_shape, mask_thr):
+        self.soft_masks = soft_masks
+        self.upsampled_size = tuple(upsampled_size)
+        self.img_shape = tuple(img_shape)
+        self.ori_shape = tuple(ori_shape)
+        self.mask_thr = mask_thr
+        self._masks = {}
+
+    @property
+    def shape(self):
+        return (len(self),) + self.ori_shape[:2]
+
+    @property
+    def device(self):
+        return self.soft_masks.device
+
+    def __len__(self):
+        return len(self.soft_masks)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __getitem__(self, idx):
+        # numpy and 0-d tensor integers select one instance like an int
+        if not torch.is_tensor(idx) or idx.dim() == 0:
+            try:
+                idx = operator.index(idx)
+            except TypeError:
+                pass
+        if isinstance(idx, int):
+            if idx < 0:
+                idx += len(self)
+            if idx not in self._masks:
+                self._masks[idx] = self.upsample(self.soft_masks[idx : idx + 1])[0]
+            return self._masks[idx]
+        return LazySegMasks(
+            self.soft_masks[idx],
+            self.upsampled_size,
+            self.img_shape,
+            self.ori_shape,
+            self.mask_thr,
+        )
+
+    def upsample(self, soft_masks):
+        """Full resolution bool masks of some of the soft masks."""
+        h, w = self.img_shape[:2]
+        soft_masks = F.interpolate(
+            soft_masks.unsqueeze(0),
+            size=self.upsampled_size,
+            mode="bilinear",
+            align_corners=False,
+        )[:, :, :h, :w]
+        soft_masks = F.interpolate(
+            soft_masks, size=self.ori_shape[:2], mode="bilinear", align_corners=False
+        ).squeeze(0)
+        return soft_masks > self.mask_thr
+
+    def dense(self):
+        """All masks as one bool tensor of shape (n, H, W)."""
+        if len(self) == 0:
+            return self.soft_masks.new_zeros(self.shape, dtype=torch.bool)
+        return torch.stack(list(self))
+
+
+class CroppedSegMasks(object):
+    """Instance masks of one image stored as crops inside the original image.
+
+    ``get_seg`` returns this when the test config sets
+    ``mask_format="cropped"``, see ``crop_upsample``. Memory grows with the
+    instance areas. Integer indexing pastes one mask into a full size bool
+    mask, ``dense()`` does so for all of them.
+
+    Args:
+        crops (list[Tensor]): per instance, bool mask of its box.
+        offsets (Tensor): shape (n, 2), (y, x) of every box.
+        ori_shape (tuple[int]): shape of the original image.
+    """
+
+    def __init__(self, crops, offsets, ori_shape):
+        self.crops = crops
+        self.offsets = offsets
+        self.ori_shape = tuple(ori_shape)
+
+    @property
+    def shape(self):
+        return (len(self),) + self.ori_shape[:2]
+
+    @property
+    def device(self):
+        return self.offsets.device
+
+    def __len__(self):
+        return len(self.crops)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __getitem__(self, idx):
+        mask = self.offsets.new_zeros(self.ori_shape[:2], dtype=torch.bool)
+        self.paste(idx, mask)
+        return mask
+
+    def paste(self, idx, mask):
+        """Write instance ``idx`` into ``mask`` of the original image size."""
+        crop = self.crops[idx]
+        y, x = self.offsets[idx].tolist()
+        mask[y : y + crop.size(0), x : x + crop.size(1)] = crop
+
+    def dense(self):
+        """All masks as one bool tensor of shape (n, H, W)."""
+        masks = self.offsets.new_zeros(self.shape, dtype=torch.bool)
+        for idx in range(len(self)):
+            self.paste(idx, masks[idx])
+        return masks
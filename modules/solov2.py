@@ -1,9 +1,12 @@
+import os
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from .backbone import resnet18, resnet34, resnet50, resnet101, resnet152
 from .nninit import xavier_init, kaiming_init
 from .solov2_head import SOLOv2Head
+from .solov2_target import SOLOv2TargetCache
 from .mask_feat_head import MaskFeatHead
 import torch.distributed as dist
 import torch.multiprocessing as m
@@ -86,7 +89,10 @@ class FPN(nn.Module):
             if isinstance(m, nn.Conv2d):
                 xavier_init(m, distribution="uniform")
 
-    def forward(self, inputs):
+    def forward(self, inputs, num_outs=None):
+        # num_outs: compute only the first num_outs outputs, at most
+        # self.num_outs; only the extra levels on top can be left out
+        num_outs = self.num_outs if num_outs is None else min(num_outs, self.num_outs)
         assert len(inputs) == len(self.in_channels)
         laterals = [
             lateral_conv(inputs[i + self.start_level])
@@ -101,11 +107,11 @@ class FPN(nn.Module):
 
         outs = [self.fpn_convs[i](laterals[i]) for i in range(used_backbone_levels)]
 
-        if self.num_outs > len(outs):
+        if num_outs > len(outs):
             # use max pool to get more levels on top of outputs
             # (e.g., Faster R-CNN, Mask R-CNN)
             if not self.add_extra_convs:
-                for i in range(self.num_outs - used_backbone_levels):
+                for i in range(num_outs - used_backbone_levels):
                     outs.append(F.max_pool2d(outs[-1], 1, stride=2))
             # add conv layers on top of original feature maps (RetinaNet)
             else:
@@ -118,7 +124,7 @@ class FPN(nn.Module):
                 else:
                     raise NotImplementedError
                 outs.append(self.fpn_convs[used_backbone_levels](extra_source))
-                for i in range(used_backbone_levels + 1, self.num_outs):
+                for i in range(used_backbone_levels + 1, num_outs):
                     if self.relu_before_extra_convs:
                         outs.append(self.fpn_convs[i](F.relu(outs[-1], inplace=False)))
                     else:
@@ -129,16 +135,37 @@ class FPN(nn.Module):
 class SOLOV2(nn.Module):
     def __init__(self, cfg=None, pretrained=None, mode="train"):
         super(SOLOV2, self).__init__()
+        frozen_stages = getattr(cfg.backbone, "frozen_stages", 1)
         if cfg.backbone.name == "resnet18":
-            self.backbone = resnet18(pretrained=True, loadpath=cfg.backbone.path)
+            self.backbone = resnet18(
+                pretrained=True,
+                loadpath=cfg.backbone.path,
+                frozen_stages=frozen_stages,
+            )
         elif cfg.backbone.name == "resnet34":
-            self.backbone = resnet34(pretrained=True, loadpath=cfg.backbone.path)
+            self.backbone = resnet34(
+                pretrained=True,
+                loadpath=cfg.backbone.path,
+                frozen_stages=frozen_stages,
+            )
         elif cfg.backbone.name == "resnet50":
-            self.backbone = resnet50(pretrained=True, loadpath=cfg.backbone.path)
+            self.backbone = resnet50(
+                pretrained=True,
+                loadpath=cfg.backbone.path,
+                frozen_stages=frozen_stages,
+            )
         elif cfg.backbone.name == "resnet101":
-            self.backbone = resnet101(pretrained=True, loadpath=cfg.backbone.path)
+            self.backbone = resnet101(
+                pretrained=True,
+                loadpath=cfg.backbone.path,
+                frozen_stages=frozen_stages,
+            )
         elif cfg.backbone.name == "resnet152":
-            self.backbone = resnet152(pretrained=True, loadpath=cfg.backbone.path)
+            self.backbone = resnet152(
+                pretrained=True,
+                loadpath=cfg.backbone.path,
+                frozen_stages=frozen_stages,
+            )
         else:
             raise NotImplementedError
 
@@ -158,6 +185,7 @@ class SOLOV2(nn.Module):
             start_level=0,
             end_level=3,
             num_classes=128,
+            fold_coord_conv=getattr(cfg, "fold_coord_conv", False),
         )
         # this set only support resnet18 and resnet34 backbone
         self.bbox_head = SOLOv2Head(
@@ -166,10 +194,49 @@ class SOLOV2(nn.Module):
             seg_feat_channels=256,
             stacked_convs=2,
             strides=[8, 8, 16, 32, 32],
-            scale_ranges=((1, 56), (28, 112), (56, 224), (112, 448), (224, 896)),
-            num_grids=[40, 36, 24, 16, 12],
+            scale_ranges=cfg.grid_cfg["scale_ranges"],
+            sigma=cfg.grid_cfg["sigma"],
+            num_grids=cfg.grid_cfg["num_grids"],
             ins_out_channels=128,
+            max_ins_per_img=getattr(cfg, "max_ins_per_img", None),
+            ins_loss_chunk=getattr(cfg, "ins_loss_chunk", None),
+            sparse_kernel=getattr(cfg, "sparse_kernel", False),
+            cate_neg_per_img=getattr(cfg, "cate_neg_per_img", None),
+            fold_coord_conv=getattr(cfg, "fold_coord_conv", False),
         )
+        if getattr(cfg, "target_cache_dir", None):
+            # the cache is read and written where the head builds the
+            # targets itself, with the pipeline it would never be used
+            if any(
+                transform.get("type") == "SOLOv2Target"
+                for transform in getattr(cfg, "train_pipeline", None) or []
+            ):
+                raise ValueError(
+                    "target_cache_dir is not used when the train pipeline "
+                    "builds the targets with SOLOv2Target, remove one of them"
+                )
+            # scale_idx of the entries indexes the img_scale of this Resize
+            resize_cfg = next(
+                (
+                    transform
+                    for transform in cfg.train_pipeline
+                    if transform.get("type") == "Resize"
+                ),
+                None,
+            )
+            # resolved as CocoDataset does
+            ann_file = cfg.dataset.train_info
+            data_root = getattr(cfg.dataset, "data_root", None)
+            if data_root is not None and not os.path.isabs(ann_file):
+                ann_file = os.path.join(data_root, ann_file)
+            self.bbox_head.target_cache = SOLOv2TargetCache(
+                cfg.target_cache_dir,
+                self.bbox_head.seg_num_grids,
+                self.bbox_head.scale_ranges,
+                self.bbox_head.sigma,
+                resize_cfg=resize_cfg,
+                ann_file=ann_file,
+            )
 
         self.mode = mode
 
@@ -210,10 +277,10 @@ class SOLOV2(nn.Module):
         state_dict = torch.load(path)
         self.load_state_dict(state_dict)
 
-    def extract_feat(self, img):
+    def extract_feat(self, img, num_outs=None):
         """Directly extract features from the backbone+neck."""
         x = self.backbone(img)
-        x = self.fpn(x)
+        x = self.fpn(x, num_outs)
         return x
 
     def forward_dummy(self, img):
@@ -240,7 +307,14 @@ class SOLOV2(nn.Module):
             return self.forward_test(img, img_meta, **kwargs)
 
     def forward_train(
-        self, img, img_metas, gt_bboxes, gt_labels, gt_bboxes_ignore=None, gt_masks=None
+        self,
+        img,
+        img_metas,
+        gt_bboxes,
+        gt_labels,
+        gt_bboxes_ignore=None,
+        gt_masks=None,
+        gt_targets=None,
     ):
         # print("img:", img.shape)
         # print("gt_bboxes:", gt_bboxes.shape)
@@ -249,14 +323,17 @@ class SOLOV2(nn.Module):
 
         x = self.extract_feat(img)
         # print("x:", len(x), x[0].shape, x[1].shape, x[2].shape, x[3].shape, x[4].shape)
-        outs = self.bbox_head(x)
+        # with sparse_kernel the loss runs solo_kernel at the positive cells only
+        outs = self.bbox_head(x, kernel_feats=self.bbox_head.sparse_kernel)
         mask_feat_pred = self.mask_feat_head(
             x[self.mask_feat_head.start_level : self.mask_feat_head.end_level + 1]
         )
         # print("mask_feat_pred:", mask_feat_pred.shape)
         loss_inputs = outs + (mask_feat_pred, gt_bboxes, gt_labels, gt_masks, img_metas)
 
-        losses = self.bbox_head.loss(*loss_inputs, gt_bboxes_ignore=gt_bboxes_ignore)
+        losses = self.bbox_head.loss(
+            *loss_inputs, gt_bboxes_ignore=gt_bboxes_ignore, gt_targets=gt_targets
+        )
         return losses
 
     # 短边resize到448，剩余的边pad到能被32整除
@@ -275,10 +352,15 @@ class SOLOV2(nn.Module):
         Args:
             imgs (List[Tensor]): the outer list indicates test-time
                 augmentations and inner Tensor should have a shape NxCxHxW,
-                which contains all images in the batch.
+                which contains all images in the batch, padded to the same
+                size.
             img_meta (List[List[dict]]): the outer list indicates test-time
                 augs (multiscale, flip, etc.) and the inner list indicates
                 images in a batch
+
+        Returns:
+            list: per image, ``(seg_masks, cate_labels, cate_scores)`` or
+                None when nothing is detected.
         """
         for var, name in [(imgs, "imgs"), (img_metas, "img_metas")]:
             if not isinstance(var, list):
@@ -291,9 +373,13 @@ class SOLOV2(nn.Module):
                     len(imgs), len(img_metas)
                 )
             )
-        # TODO: remove the restriction of imgs_per_gpu == 1 when prepared
         imgs_per_gpu = imgs[0].size(0)
-        assert imgs_per_gpu == 1
+        if imgs_per_gpu != len(img_metas[0]):
+            raise ValueError(
+                "num of images ({}) != num of image meta ({})".format(
+                    imgs_per_gpu, len(img_metas[0])
+                )
+            )
 
         if num_augs == 1:
             return self.simple_test(imgs[0], img_metas[0], **kwargs)
@@ -303,9 +389,30 @@ class SOLOV2(nn.Module):
     def simple_test(self, img, img_meta, rescale=False):
         # test_tensor = torch.ones(1,3,448,512).cuda()
         # x = self.extract_feat(test_tensor)
-        x = self.extract_feat(img)
-
-        outs = self.bbox_head(x, eval=True)
+        levels = self.test_cfg.get("levels")
+        num_outs = None
+        if levels is not None:
+            # the FPN outputs above the mask features and the head levels
+            # run are not needed (P6 when the last level is off)
+            num_outs = max(self.mask_feat_head.end_level, max(levels)) + 1
+        x = self.extract_feat(img, num_outs)
+
+        kernel_feats = self.bbox_head.sparse_kernel
+        if self.test_cfg.get("cate_first", False):
+            # category branch first, the kernel branch and the mask features
+            # are only computed when a cell passes score_thr in some image
+            cate_preds, _ = self.bbox_head(x, eval=True, kernel=False, levels=levels)
+            max_score = torch.stack([pred.max() for pred in cate_preds]).max()
+            if float(max_score) <= self.test_cfg["score_thr"]:
+                return [None] * len(img_meta)
+            _, kernel_preds = self.bbox_head(
+                x, eval=True, cate=False, levels=levels, kernel_feats=kernel_feats
+            )
+            outs = (cate_preds, kernel_preds)
+        else:
+            outs = self.bbox_head(
+                x, eval=True, levels=levels, kernel_feats=kernel_feats
+            )
 
         mask_feat_pred = self.mask_feat_head(
             x[self.mask_feat_head.start_level : self.mask_feat_head.end_level + 1]
@@ -1,14 +1,21 @@
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from data.imgutils import imrescale
 
 from .nninit import xavier_init, kaiming_init, normal_init, bias_init_with_prob
-from .misc import multi_apply, matrix_nms
-
-# from .focal_loss import FocalLoss
-from scipy import ndimage
-from focal_loss.focal_loss import FocalLoss
+from .coord_conv import CoordBias, coord_feat
+from .misc import multi_apply, matrix_nms, matrix_nms_sparse, matrix_nms_tiled
+from .solov2_target import (
+    grid_fingerprint,
+    grid_labels,
+    mass_centers,
+    rescale_masks,
+    solov2_assign_grids,
+)
+
+from .focal_loss import FocalLoss
+from .seg_masks import CroppedSegMasks, LazySegMasks, band_upsample, crop_upsample
 
 INF = 1e8
 
@@ -30,6 +37,60 @@ def dice_loss(input, target):
     return 1 - d
 
 
+class ChunkedDiceLoss(torch.autograd.Function):
+    """Summed dice loss of the predicted masks, a chunk of masks at a time.
+
+    The masks of image ``i`` are ``kernels @ feats[i]`` for its rows of
+    ``kernels``. Neither pass holds more than ``chunk`` masks: forward keeps
+    only the kernels and backward computes the masks again and accumulates
+    the feature gradient in place.
+    """
+
+    @staticmethod
+    def forward(ctx, kernels, feats, ins_masks, ins_labels, num_rows, chunk):
+        ctx.save_for_backward(kernels, feats, ins_masks, ins_labels)
+        ctx.num_rows = num_rows
+        ctx.chunk = chunk
+        loss = feats.new_zeros(())
+        for feat, start, end in ChunkedDiceLoss._chunks(feats, num_rows, chunk):
+            masks = torch.sigmoid(kernels[start:end].mm(feat))
+            loss += dice_loss(masks, ins_masks[ins_labels[start:end]]).sum()
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        kernels, feats, ins_masks, ins_labels = ctx.saved_tensors
+        grad_kernels = torch.empty_like(kernels)
+        grad_feats = torch.zeros_like(feats)
+        for idx, start, end in ChunkedDiceLoss._chunks(
+            range(len(feats)), ctx.num_rows, ctx.chunk
+        ):
+            masks = torch.sigmoid(kernels[start:end].mm(feats[idx]))
+            target = ins_masks[ins_labels[start:end]].float()
+            # d(1 - 2a / (b + c)) with a = sum(x * t), b = sum(x * x) + 0.001
+            # and c = sum(t * t) + 0.001, through the sigmoid
+            a = torch.sum(masks * target, 1, keepdim=True)
+            bc = (
+                torch.sum(masks * masks, 1, keepdim=True)
+                + 0.001
+                + torch.sum(target * target, 1, keepdim=True)
+                + 0.001
+            )
+            grad_masks = (4 * a / bc**2) * masks - (2 / bc) * target
+            grad_masks *= masks * (1 - masks) * grad_output
+            grad_kernels[start:end] = grad_masks.mm(feats[idx].t())
+            grad_feats[idx].addmm_(kernels[start:end].t(), grad_masks)
+        return grad_kernels, grad_feats, None, None, None, None
+
+    @staticmethod
+    def _chunks(items, num_rows, chunk):
+        img_start = 0
+        for item, rows in zip(items, num_rows):
+            for start in range(img_start, img_start + rows, chunk):
+                yield item, start, min(start + chunk, img_start + rows)
+            img_start += rows
+
+
 class SOLOv2Head(nn.Module):
     def __init__(
         self,
@@ -47,6 +108,11 @@ class SOLOv2Head(nn.Module):
         loss_cate=None,
         conv_cfg=None,
         norm_cfg=None,
+        max_ins_per_img=None,  # cap of positive masks per image in loss_ins
+        ins_loss_chunk=None,  # masks per chunk of a memory bounded loss_ins
+        sparse_kernel=False,  # run solo_kernel only at the cells in use
+        cate_neg_per_img=None,  # sampled negative cells per image in loss_cate
+        fold_coord_conv=False,  # coordinates as a cached bias at inference
     ):
         super(SOLOv2Head, self).__init__()
         self.num_classes = num_classes
@@ -63,13 +129,23 @@ class SOLOv2Head(nn.Module):
         self.base_edge_list = base_edge_list
         self.scale_ranges = scale_ranges
 
-        # self.loss_cate = FocalLoss(
-        #     use_sigmoid=True, gamma=2.0, alpha=0.25, loss_weight=1.0
-        # )  # build_loss Focal_loss
-
-        self.loss_cate = FocalLoss(gamma=2.0, reduction="mean", ignore_index=80)
+        self.loss_cate = FocalLoss(
+            use_sigmoid=True, gamma=2.0, alpha=0.25, loss_weight=1.0
+        )  # build_loss Focal_loss
 
         self.ins_loss_weight = 3.0  # loss_ins['loss_weight']  #3.0
+        self.max_ins_per_img = max_ins_per_img
+        self.ins_loss_chunk = ins_loss_chunk
+        self.sparse_kernel = sparse_kernel
+        self.cate_neg_per_img = cate_neg_per_img
+        self.coord_bias = CoordBias() if fold_coord_conv else None
+        # settings of the grids the SOLOv2Target pipeline assigned, they are
+        # reused only when equal
+        self.grid_fingerprint = grid_fingerprint(
+            self.seg_num_grids, self.scale_ranges, self.sigma
+        )
+        # optional SOLOv2TargetCache, set by SOLOV2 from cfg.target_cache_dir
+        self.target_cache = None
         self.norm_cfg = norm_cfg
         self._init_layers()
 
@@ -136,78 +212,126 @@ class SOLOv2Head(nn.Module):
         normal_init(self.solo_cate, std=0.01, bias=bias_cate)
         normal_init(self.solo_kernel, std=0.01)
 
-    def forward(self, feats, eval=False):
-        new_feats = self.split_feats(feats)
-        # print(
-        #     "new_feats",
-        #     len(new_feats),
-        #     new_feats[0].shape,
-        #     new_feats[1].shape,
-        #     new_feats[2].shape,
-        #     new_feats[3].shape,
-        #     new_feats[4].shape,
-        # )
-        featmap_sizes = [featmap.size()[-2:] for featmap in new_feats]
-        upsampled_size = (featmap_sizes[0][0] * 2, featmap_sizes[0][1] * 2)
-        # print("upsampled_size", upsampled_size)
+    def forward(
+        self, feats, eval=False, cate=True, kernel=True, levels=None, kernel_feats=False
+    ):
+        # cate / kernel: run that branch, the predictions of a skipped branch
+        # are None. levels: indices of the levels to run, the predictions are
+        # those of these levels only; None runs all of them. kernel_feats:
+        # return the kernel branch features (N, C, G, G) instead of the
+        # kernels, for gather_kernels when sparse_kernel is set
+        if levels is None:
+            levels = list(range(len(self.seg_num_grids)))
+        new_feats = self.split_feats(feats, levels)
+        upsampled_size = tuple(feats[0].size()[-2:])
         cate_pred, kernel_pred = multi_apply(
             self.forward_single,
             new_feats,
-            list(range(len(self.seg_num_grids))),
+            levels,
             eval=eval,
             upsampled_size=upsampled_size,
+            cate=cate,
+            kernel=kernel,
+            kernel_feats=kernel_feats,
         )
         return cate_pred, kernel_pred
 
-    def split_feats(self, feats):
-        return (
-            F.interpolate(
-                feats[0],
-                scale_factor=0.5,
-                mode="bilinear",
-                align_corners=False,
-                recompute_scale_factor=True,
-            ),
-            feats[1],
-            feats[2],
-            feats[3],
-            F.interpolate(
-                feats[4], size=feats[3].shape[-2:], mode="bilinear", align_corners=False
-            ),
-        )
+    def split_feats(self, feats, levels=None):
+        # levels: indices of the levels to return, all of them when None
+        if levels is None:
+            levels = range(len(self.seg_num_grids))
+        new_feats = []
+        for idx in levels:
+            if idx == 0:
+                new_feats.append(
+                    F.interpolate(
+                        feats[0],
+                        scale_factor=0.5,
+                        mode="bilinear",
+                        align_corners=False,
+                        recompute_scale_factor=True,
+                    )
+                )
+            elif idx == 4:
+                new_feats.append(
+                    F.interpolate(
+                        feats[4],
+                        size=feats[3].shape[-2:],
+                        mode="bilinear",
+                        align_corners=False,
+                    )
+                )
+            else:
+                new_feats.append(feats[idx])
+        return tuple(new_feats)
 
-    def forward_single(self, x, idx, eval=False, upsampled_size=None):
+    def forward_single(
+        self,
+        x,
+        idx,
+        eval=False,
+        upsampled_size=None,
+        cate=True,
+        kernel=True,
+        kernel_feats=False,
+    ):
         ins_kernel_feat = x
-        # ins branch
-        # concat coord
-        x_range = torch.linspace(
-            -1, 1, ins_kernel_feat.shape[-1], device=ins_kernel_feat.device
-        )
-        y_range = torch.linspace(
-            -1, 1, ins_kernel_feat.shape[-2], device=ins_kernel_feat.device
-        )
-        y, x = torch.meshgrid(y_range, x_range)
-        y = y.expand([ins_kernel_feat.shape[0], 1, -1, -1])
-        x = x.expand([ins_kernel_feat.shape[0], 1, -1, -1])
-        coord_feat = torch.cat([x, y], 1)
-        ins_kernel_feat = torch.cat([ins_kernel_feat, coord_feat], 1)
-
-        # kernel branch
-        kernel_feat = ins_kernel_feat
-        # print("kernel_feat", kernel_feat.shape)
         seg_num_grid = self.seg_num_grids[idx]
-        # print("seg_num_grid", seg_num_grid)
-        kernel_feat = F.interpolate(
-            kernel_feat, size=seg_num_grid, mode="bilinear", align_corners=False
-        )
-        # print("kernel_feat_after_grids", kernel_feat.shape)
-        cate_feat = kernel_feat[:, :-2, :, :]
-
-        kernel_feat = kernel_feat.contiguous()
-        for i, kernel_layer in enumerate(self.kernel_convs):
-            kernel_feat = kernel_layer(kernel_feat)
-        kernel_pred = self.solo_kernel(kernel_feat)
+        cate_pred = kernel_pred = None
+        if not kernel:
+            # the category branch alone does not need the coordinates
+            cate_feat = F.interpolate(
+                x, size=seg_num_grid, mode="bilinear", align_corners=False
+            )
+        elif self.coord_bias is not None and not self.training:
+            # the coordinates enter the first kernel conv as a bias
+            coord_size = ins_kernel_feat.shape[-2:]
+            kernel_feat = F.interpolate(
+                ins_kernel_feat,
+                size=seg_num_grid,
+                mode="bilinear",
+                align_corners=False,
+            )
+            cate_feat = kernel_feat
+            first_layer = self.kernel_convs[0]
+            kernel_feat = first_layer[1:](
+                self.coord_bias(first_layer[0], kernel_feat, coord_size, seg_num_grid)
+            )
+            kernel_layers = self.kernel_convs[1:]
+        else:
+            # ins branch
+            # concat coord
+            coord = coord_feat(
+                ins_kernel_feat.shape[0],
+                ins_kernel_feat.shape[-2],
+                ins_kernel_feat.shape[-1],
+                device=ins_kernel_feat.device,
+            )
+            ins_kernel_feat = torch.cat([ins_kernel_feat, coord], 1)
+
+            # kernel branch
+            kernel_feat = ins_kernel_feat
+            # print("kernel_feat", kernel_feat.shape)
+            # print("seg_num_grid", seg_num_grid)
+            kernel_feat = F.interpolate(
+                kernel_feat, size=seg_num_grid, mode="bilinear", align_corners=False
+            )
+            # print("kernel_feat_after_grids", kernel_feat.shape)
+            cate_feat = kernel_feat[:, :-2, :, :]
+            kernel_feat = kernel_feat.contiguous()
+            kernel_layers = self.kernel_convs
+
+        if kernel:
+            for i, kernel_layer in enumerate(kernel_layers):
+                kernel_feat = kernel_layer(kernel_feat)
+            if kernel_feats:
+                # solo_kernel is applied later at the cells in use, gather_kernels
+                kernel_pred = kernel_feat
+            else:
+                kernel_pred = self.solo_kernel(kernel_feat)
 
+        if not cate:
+            return cate_pred, kernel_pred
         # cate branch
         cate_feat = cate_feat.contiguous()
         for i, cate_layer in enumerate(self.cate_convs):
@@ -231,77 +355,95 @@ class SOLOv2Head(nn.Module):
         img_metas,
         cfg=None,
         gt_bboxes_ignore=None,
+        gt_targets=None,
     ):
         mask_feat_size = ins_pred.size()[-2:]
         # print("mask_feat_size", mask_feat_size)
+        if gt_targets is None:
+            target_results = multi_apply(
+                self.solov2_target_single,
+                gt_bbox_list,
+                gt_label_list,
+                gt_mask_list,
+                img_metas,
+                mask_feat_size=mask_feat_size,
+            )
+        else:
+            # built by the SOLOv2Target pipeline in the loader workers, grids
+            # assigned with other settings than the head's are assigned again
+            # from the mass centers
+            stale = [
+                img_meta.get("grid_fingerprint") != self.grid_fingerprint
+                for img_meta in img_metas
+            ]
+            target_results = multi_apply(
+                self.solov2_target_prepared,
+                gt_bbox_list,
+                gt_label_list,
+                gt_targets["ins_labels"],
+                gt_targets["gt_centers"],
+                gt_targets["gt_areas"],
+                [img_meta["pad_shape"] for img_meta in img_metas],
+                *[
+                    [None if s else target for s, target in zip(stale, targets)]
+                    for targets in (
+                        gt_targets["cate_labels"],
+                        gt_targets["ins_ind_labels"],
+                        gt_targets["grid_orders"],
+                        gt_targets["ins_indices"],
+                    )
+                ],
+                mask_feat_size=mask_feat_size,
+            )
         (
-            ins_label_list,
+            ins_mask_list,
             cate_label_list,
             ins_ind_label_list,
             grid_order_list,
-        ) = multi_apply(
-            self.solov2_target_single,
-            gt_bbox_list,
-            gt_label_list,
-            gt_mask_list,
-            mask_feat_size=mask_feat_size,
-        )
-
-        # ins
-        ins_labels = [
+            ins_index_list,
+        ) = target_results
+
+        # ins, every instance mask is kept once and positive cells index it
+        ins_masks = torch.cat(ins_mask_list, 0)
+        ins_offsets = [0]
+        for img_ins_masks in ins_mask_list[:-1]:
+            ins_offsets.append(ins_offsets[-1] + len(img_ins_masks))
+
+        # positive cells of every image over all levels, as columns of the
+        # level-concatenated kernel map
+        img_cells = [
             torch.cat(
-                [ins_labels_level_img for ins_labels_level_img in ins_labels_level], 0
-            )
-            for ins_labels_level in zip(*ins_label_list)
-        ]
-        # print(
-        #     len(kernel_preds),
-        #     kernel_preds[0].shape,
-        #     kernel_preds[1].shape,
-        #     kernel_preds[2].shape,
-        #     kernel_preds[3].shape,
-        #     kernel_preds[4].shape,
-        # )
-        # print(grid_order_list[0])
-        kernel_preds = [
-            [
-                kernel_preds_level_img.view(kernel_preds_level_img.shape[0], -1)[
-                    :, grid_orders_level_img
+                [
+                    grid_order + level_start
+                    for grid_order, level_start in zip(
+                        grid_orders_img, self.level_starts()
+                    )
                 ]
-                for kernel_preds_level_img, grid_orders_level_img in zip(
-                    kernel_preds_level, grid_orders_level
-                )
-            ]
-            for kernel_preds_level, grid_orders_level in zip(
-                kernel_preds, zip(*grid_order_list)
             )
+            for grid_orders_img in grid_order_list
+        ]
+        img_ins_labels = [
+            torch.cat(ins_indices_img) + offset
+            for ins_indices_img, offset in zip(ins_index_list, ins_offsets)
         ]
-        # print(kernel_preds[0][0].shape, kernel_preds[1][0].shape)
+        if self.max_ins_per_img is not None:
+            # uniformly sampled subset of the positives of crowded images
+            for idx, cells in enumerate(img_cells):
+                if len(cells) > self.max_ins_per_img:
+                    keep = torch.randperm(len(cells), device=cells.device)[
+                        : self.max_ins_per_img
+                    ]
+                    img_cells[idx] = cells[keep]
+                    img_ins_labels[idx] = img_ins_labels[idx][keep]
+
         # generate masks
-        ins_pred = ins_pred
-        ins_pred_list = []
-        for b_kernel_pred in kernel_preds:
-            b_mask_pred = []
-            for idx, kernel_pred in enumerate(b_kernel_pred):
-                if kernel_pred.size()[-1] == 0:
-                    continue
-                cur_ins_pred = ins_pred[idx, ...]
-                H, W = cur_ins_pred.shape[-2:]
-                N, I = kernel_pred.shape
-                cur_ins_pred = cur_ins_pred.unsqueeze(0)
-                # print("cur_ins_pred", cur_ins_pred.shape)
-                kernel_pred = kernel_pred.permute(1, 0).view(I, -1, 1, 1)
-                # print("kernel_pred", kernel_pred.shape)
-                cur_ins_pred = F.conv2d(cur_ins_pred, kernel_pred, stride=1).view(
-                    -1, H, W
-                )
-                # print("cur_ins_pred", cur_ins_pred.shape)
-                b_mask_pred.append(cur_ins_pred)
-            if len(b_mask_pred) == 0:
-                b_mask_pred = None
-            else:
-                b_mask_pred = torch.cat(b_mask_pred, 0)
-            ins_pred_list.append(b_mask_pred)
+        H, W = ins_pred.shape[-2:]
+        max_cells = max(len(cells) for cells in img_cells)
+        if max_cells > 0:
+            img_kernels = self.gather_kernels(kernel_preds, img_cells)
+        if max_cells > 0 and self.ins_loss_chunk is None:
+            ins_pred_masks = self.dynamic_conv(img_kernels, ins_pred)
+            ins_labels = torch.cat(img_ins_labels)
 
         ins_ind_labels = [
             torch.cat(
@@ -317,14 +459,16 @@ class SOLOv2Head(nn.Module):
         num_ins = flatten_ins_ind_labels.sum()
 
         # dice loss
-        loss_ins = []
-        for input, target in zip(ins_pred_list, ins_labels):
-            if input is None:
-                continue
-            # print(input.shape, target.shape)
-            input = torch.sigmoid(input)
-            loss_ins.append(dice_loss(input, target))
-        loss_ins = torch.cat(loss_ins).mean()
+        if max_cells > 0 and self.ins_loss_chunk is not None:
+            loss_ins = self.chunked_dice_loss(
+                img_kernels, ins_pred, img_ins_labels, ins_masks
+            )
+        elif max_cells > 0:
+            loss_ins = dice_loss(
+                torch.sigmoid(ins_pred_masks), ins_masks[ins_labels].view(-1, H * W)
+            ).mean()
+        else:
+            loss_ins = ins_pred.sum() * 0
         loss_ins = loss_ins * self.ins_loss_weight
 
         # cate
@@ -345,184 +489,410 @@ class SOLOv2Head(nn.Module):
         ]
         flatten_cate_preds = torch.cat(cate_preds)
         flatten_cate_labels = flatten_cate_labels.long()
-        flatten_cate_preds = nn.functional.softmax(flatten_cate_preds, dim=1)
         # print(flatten_cate_preds.shape, flatten_cate_labels.shape)
         # # print(flatten_cate_preds.max(), flatten_cate_preds.min())
         # print(flatten_cate_labels.max(), flatten_cate_labels.min())
-        loss_cate = self.loss_cate(flatten_cate_preds, flatten_cate_labels)
+        if self.cate_neg_per_img is None:
+            loss_cate = self.loss_cate(
+                flatten_cate_preds, flatten_cate_labels, avg_factor=num_ins + 1
+            )
+        else:
+            cate_inds, cate_weights = self.sample_cate_cells(
+                flatten_cate_preds, flatten_cate_labels, ins_pred.size(0)
+            )
+            loss_cate = self.loss_cate(
+                flatten_cate_preds[cate_inds],
+                flatten_cate_labels[cate_inds],
+                cate_weights,
+                avg_factor=num_ins + 1,
+            )
         # loss_cate = torch.zeros(1, device=flatten_cate_preds.device)
         return dict(loss_ins=loss_ins, loss_cate=loss_cate)
 
+    def sample_cate_cells(self, cate_preds, cate_labels, num_imgs):
+        """All positive cells and a hardness-weighted sample of negatives.
+
+        ``cate_neg_per_img`` negatives per image are drawn with replacement,
+        half by hardness (the squared top class score, a cheap bound of the
+        focal loss of a negative) and half uniformly. Every drawn negative is
+        weighted by its count over its expected count, so the weighted loss
+        is an unbiased estimate of the loss over all negatives and keeps the
+        same ``avg_factor`` normalization.
+
+        Returns:
+            tuple(Tensor): indices of the kept cells and their loss weights.
+        """
+        pos_inds = (cate_labels > 0).nonzero().flatten()
+        neg_inds = (cate_labels == 0).nonzero().flatten()
+        num_samples = self.cate_neg_per_img * num_imgs
+        if len(neg_inds) <= num_samples:
+            return (
+                torch.cat([pos_inds, neg_inds]),
+                cate_preds.new_ones(len(pos_inds) + len(neg_inds)),
+            )
+        with torch.no_grad():
+            hardness = cate_preds[neg_inds].max(1)[0].sigmoid().pow(2)
+            probs = 0.5 * hardness / hardness.sum() + 0.5 / len(neg_inds)
+            samples = torch.multinomial(probs, num_samples, replacement=True)
+            samples, counts = torch.unique(samples, return_counts=True)
+            neg_weights = counts.float() / (num_samples * probs[samples])
+        return (
+            torch.cat([pos_inds, neg_inds[samples]]),
+            torch.cat([cate_preds.new_ones(len(pos_inds)), neg_weights]),
+        )
+
+    def level_starts(self, levels=None):
+        """Offset of every level in the level-concatenated grid cells, of the
+        grids of ``levels`` only when it is given."""
+        grids = self.seg_num_grids
+        if levels is not None:
+            grids = [grids[idx] for idx in levels]
+        level_starts = [0]
+        for num_grid in grids[:-1]:
+            level_starts.append(level_starts[-1] + num_grid**2)
+        return level_starts
+
+    def solo_kernel_at(self, kernel_feat, cells):
+        """``solo_kernel`` evaluated at some cells of one grid only.
+
+        Args:
+            kernel_feat (Tensor): last kernel branch feature, (C, G, G).
+            cells (Tensor): flattened cells to evaluate.
+
+        Returns:
+            Tensor: kernels of the cells, shape (len(cells), I).
+        """
+        num_channels, num_grid = kernel_feat.shape[:2]
+        padded = F.pad(kernel_feat, (1, 1, 1, 1)).reshape(num_channels, -1)
+        # the 3x3 neighbourhood of every cell in the padded grid, row-major
+        offsets = torch.arange(3, device=cells.device)
+        offsets = (offsets[:, None] * (num_grid + 2) + offsets[None, :]).flatten()
+        rows = cells // num_grid
+        cols = cells % num_grid
+        patches = padded[:, (rows * (num_grid + 2) + cols)[:, None] + offsets]
+        patches = patches.permute(1, 0, 2).reshape(len(cells), -1)
+        weight = self.solo_kernel.weight.reshape(self.kernel_out_channels, -1)
+        return torch.addmm(self.solo_kernel.bias, patches, weight.t())
+
+    def gather_kernels(self, kernel_preds, img_cells, levels=None):
+        """Kernels of some cells of every image.
+
+        Args:
+            kernel_preds (list[Tensor]): per level, the kernel predictions
+                (N, I, G, G), or when ``sparse_kernel`` is set the kernel
+                branch features (N, C, G, G) of ``forward(kernel_feats=True)``.
+            img_cells (list[Tensor]): per image, cells indexing the
+                level-concatenated grids.
+            levels (list[int] | None): indices of the levels of
+                ``kernel_preds``, all levels when None.
+
+        Returns:
+            list[Tensor]: per image, kernels of shape (len(cells), I).
+        """
+        num_channels = (
+            self.seg_feat_channels if self.sparse_kernel else self.kernel_out_channels
+        )
+        if kernel_preds[0].size(1) != num_channels:
+            raise ValueError(
+                "kernel_preds have {} channels, expected {}: with sparse_kernel "
+                "pass the features of forward(kernel_feats=True), else the "
+                "kernels of forward()".format(kernel_preds[0].size(1), num_channels)
+            )
+        grids = self.seg_num_grids
+        if levels is not None:
+            grids = [grids[idx] for idx in levels]
+        img_kernels = []
+        for idx, cells in enumerate(img_cells):
+            if not self.sparse_kernel:
+                flatten_kernel_preds = torch.cat(
+                    [
+                        kernel_pred[idx].reshape(self.kernel_out_channels, -1)
+                        for kernel_pred in kernel_preds
+                    ],
+                    1,
+                )
+                img_kernels.append(flatten_kernel_preds[:, cells].t())
+                continue
+            kernels = kernel_preds[0].new_empty((len(cells), self.kernel_out_channels))
+            for kernel_feat, level_start, num_grid in zip(
+                kernel_preds, self.level_starts(levels), grids
+            ):
+                in_level = (cells >= level_start) & (cells < level_start + num_grid**2)
+                if in_level.any():
+                    kernels[in_level] = self.solo_kernel_at(
+                        kernel_feat[idx], cells[in_level] - level_start
+                    )
+            img_kernels.append(kernels)
+        return img_kernels
+
+    def dynamic_conv(self, img_kernels, ins_pred):
+        """Masks of the positive cells of all levels and images at once.
+
+        Every image convolves its mask features with its kernels. The kernels
+        are padded to the largest count so the whole batch is a single
+        ``bmm``.
+
+        Args:
+            img_kernels (list[Tensor]): per image, kernels of shape (P, I).
+            ins_pred (Tensor): mask features, shape (N, I, H, W).
+
+        Returns:
+            Tensor: shape (sum of P, H * W), image-major.
+        """
+        num_imgs, _, H, W = ins_pred.shape
+        max_cells = max(len(kernels) for kernels in img_kernels)
+        padded_kernels = ins_pred.new_zeros(
+            (num_imgs, max_cells, self.kernel_out_channels)
+        )
+        cell_valid = ins_pred.new_zeros((num_imgs, max_cells), dtype=torch.bool)
+        for idx, kernels in enumerate(img_kernels):
+            padded_kernels[idx, : len(kernels)] = kernels
+            cell_valid[idx, : len(kernels)] = True
+        return torch.bmm(padded_kernels, ins_pred.reshape(num_imgs, -1, H * W))[
+            cell_valid
+        ]
+
+    def chunked_dice_loss(self, img_kernels, ins_pred, img_ins_labels, ins_masks):
+        """Mean dice loss of all positive masks, ``ins_loss_chunk`` at a time.
+
+        The peak memory of forward and backward does not grow with the number
+        of positives, see ``ChunkedDiceLoss``.
+        """
+        num_imgs, _, H, W = ins_pred.shape
+        kernels = torch.cat(img_kernels)
+        loss_sum = ChunkedDiceLoss.apply(
+            kernels,
+            ins_pred.reshape(num_imgs, -1, H * W),
+            ins_masks.view(len(ins_masks), -1),
+            torch.cat(img_ins_labels),
+            [len(k) for k in img_kernels],
+            self.ins_loss_chunk,
+        )
+        return loss_sum / len(kernels)
+
     def solov2_target_single(
-        self, gt_bboxes_raw, gt_labels_raw, gt_masks_raw, mask_feat_size
+        self,
+        gt_bboxes_raw,
+        gt_labels_raw,
+        gt_masks_raw,
+        img_meta=None,
+        mask_feat_size=None,
     ):
-        device = gt_labels_raw[0].device
-
-        # ins
-        gt_areas = torch.sqrt(
-            (gt_bboxes_raw[:, 2] - gt_bboxes_raw[:, 0])
-            * (gt_bboxes_raw[:, 3] - gt_bboxes_raw[:, 1])
+        output_stride = 4
+        upsampled_size = (
+            mask_feat_size[0] * output_stride,
+            mask_feat_size[1] * output_stride,
         )
 
-        ins_label_list = []
-        cate_label_list = []
-        ins_ind_label_list = []
-        grid_order_list = []
-        for (lower_bound, upper_bound), stride, num_grid in zip(
-            self.scale_ranges, self.strides, self.seg_num_grids
-        ):
-            hit_indices = (
-                ((gt_areas >= lower_bound) & (gt_areas <= upper_bound))
-                .nonzero()
-                .flatten()
+        cache_key = None
+        if self.target_cache is not None and img_meta is not None:
+            cache_key = self.target_cache.key(img_meta)
+        if cache_key is not None:
+            cached = self.target_cache.get(
+                cache_key, len(gt_labels_raw), img_meta["img_shape"]
             )
-            num_ins = len(hit_indices)
+            if cached is not None:
+                return self.solov2_target_prepared(
+                    gt_bboxes_raw,
+                    gt_labels_raw,
+                    # copy out of the read-only memory map
+                    torch.from_numpy(np.array(cached["masks"])),
+                    torch.from_numpy(cached["centers"]),
+                    torch.from_numpy(cached["areas"]),
+                    cached["upsampled_size"],
+                    grid_orders=[torch.from_numpy(g) for g in cached["grid_orders"]],
+                    ins_indices=[torch.from_numpy(i) for i in cached["ins_indices"]],
+                    mask_feat_size=mask_feat_size,
+                )
 
-            ins_label = []
-            grid_order = []
-            cate_label = torch.zeros(
-                [num_grid, num_grid], dtype=torch.int64, device=device
-            )
-            ins_ind_label = torch.zeros(
-                [num_grid**2], dtype=torch.bool, device=device
+        # mass centers and stride-4 masks of all instances at once
+        centers, areas = mass_centers(gt_masks_raw)
+        seg_masks = rescale_masks(gt_masks_raw, 1.0 / output_stride)
+        targets = self.solov2_target_prepared(
+            gt_bboxes_raw,
+            gt_labels_raw,
+            torch.from_numpy(seg_masks),
+            torch.from_numpy(centers),
+            torch.from_numpy(areas),
+            upsampled_size,
+            mask_feat_size=mask_feat_size,
+        )
+        if cache_key is not None:
+            _, _, _, grid_order_list, ins_index_list = targets
+            self.target_cache.put(
+                cache_key,
+                img_meta["img_shape"],
+                seg_masks,
+                centers,
+                areas,
+                upsampled_size,
+                [grid_order.cpu().numpy() for grid_order in grid_order_list],
+                [ins_index.cpu().numpy() for ins_index in ins_index_list],
             )
+        return targets
 
-            if num_ins == 0:
-                ins_label = torch.zeros(
-                    [0, mask_feat_size[0], mask_feat_size[1]],
-                    dtype=torch.uint8,
-                    device=device,
-                )
-                ins_label_list.append(ins_label)
-                cate_label_list.append(cate_label)
-                ins_ind_label_list.append(ins_ind_label)
-                grid_order_list.append([])
-                continue
-            gt_bboxes = gt_bboxes_raw[hit_indices]
-            gt_labels = gt_labels_raw[hit_indices]
-            gt_masks = gt_masks_raw[hit_indices.cpu().numpy(), ...]
+    def solov2_target_prepared(
+        self,
+        gt_bboxes_raw,
+        gt_labels_raw,
+        ins_labels,
+        gt_centers,
+        gt_areas,
+        target_size,
+        cate_labels=None,
+        ins_ind_labels=None,
+        grid_orders=None,
+        ins_indices=None,
+        mask_feat_size=None,
+    ):
+        """Targets of one image from masks and grids computed beforehand.
+
+        ``ins_labels``, ``gt_centers`` and ``gt_areas`` come from the
+        ``SOLOv2Target`` pipeline or the target cache. The grids were assigned
+        for a padded input of ``target_size``. They are reused when the batch
+        has the same padded size, otherwise they are assigned again from the
+        mass centers.
+        """
+        device = gt_labels_raw.device
+        output_stride = 4
+        upsampled_size = (
+            mask_feat_size[0] * output_stride,
+            mask_feat_size[1] * output_stride,
+        )
 
-            half_ws = 0.5 * (gt_bboxes[:, 2] - gt_bboxes[:, 0]) * self.sigma
-            half_hs = 0.5 * (gt_bboxes[:, 3] - gt_bboxes[:, 1]) * self.sigma
+        ins_masks = torch.zeros(
+            [len(ins_labels), mask_feat_size[0], mask_feat_size[1]],
+            dtype=torch.uint8,
+            device=device,
+        )
+        ins_masks[:, : ins_labels.shape[1], : ins_labels.shape[2]] = ins_labels.to(
+            device
+        )
 
-            output_stride = 4
-            for seg_mask, gt_label, half_h, half_w in zip(
-                gt_masks, gt_labels, half_hs, half_ws
-            ):
-                if seg_mask.sum() == 0:
-                    continue
-                # mass center
-                upsampled_size = (mask_feat_size[0] * 4, mask_feat_size[1] * 4)
-                center_h, center_w = ndimage.measurements.center_of_mass(seg_mask)
-                coord_w = int((center_w / upsampled_size[1]) // (1.0 / num_grid))
-                coord_h = int((center_h / upsampled_size[0]) // (1.0 / num_grid))
-
-                # left, top, right, down
-                top_box = max(
-                    0,
-                    int(((center_h - half_h) / upsampled_size[0]) // (1.0 / num_grid)),
-                )
-                down_box = min(
-                    num_grid - 1,
-                    int(((center_h + half_h) / upsampled_size[0]) // (1.0 / num_grid)),
-                )
-                left_box = max(
-                    0,
-                    int(((center_w - half_w) / upsampled_size[1]) // (1.0 / num_grid)),
-                )
-                right_box = min(
-                    num_grid - 1,
-                    int(((center_w + half_w) / upsampled_size[1]) // (1.0 / num_grid)),
+        if grid_orders is not None and tuple(target_size[:2]) == upsampled_size:
+            grid_order_list = [grid_order.to(device) for grid_order in grid_orders]
+            ins_index_list = [ins_index.to(device) for ins_index in ins_indices]
+            if cate_labels is not None:
+                cate_label_list = [cate_label.to(device) for cate_label in cate_labels]
+                ins_ind_label_list = [
+                    ins_ind_label.to(device) for ins_ind_label in ins_ind_labels
+                ]
+            else:
+                cate_label_list, ins_ind_label_list = map(
+                    list,
+                    zip(
+                        *[
+                            grid_labels(num_grid, grid_order, ins_index, gt_labels_raw)
+                            for num_grid, grid_order, ins_index in zip(
+                                self.seg_num_grids, grid_order_list, ins_index_list
+                            )
+                        ]
+                    ),
                 )
+        else:
+            level_targets = solov2_assign_grids(
+                gt_bboxes_raw,
+                gt_labels_raw,
+                gt_centers,
+                (gt_areas > 0).to(device),
+                upsampled_size,
+                self.seg_num_grids,
+                self.scale_ranges,
+                self.sigma,
+            )
+            cate_label_list, ins_ind_label_list, grid_order_list, ins_index_list = (
+                list(level_target) for level_target in zip(*level_targets)
+            )
 
-                top = max(top_box, coord_h - 1)
-                down = min(down_box, coord_h + 1)
-                left = max(coord_w - 1, left_box)
-                right = min(right_box, coord_w + 1)
-
-                cate_label[top : (down + 1), left : (right + 1)] = gt_label
-                seg_mask = imrescale(seg_mask, scale=1.0 / output_stride)
-                seg_mask = torch.Tensor(seg_mask)
-                for i in range(top, down + 1):
-                    for j in range(left, right + 1):
-                        label = int(i * num_grid + j)
-
-                        cur_ins_label = torch.zeros(
-                            [mask_feat_size[0], mask_feat_size[1]],
-                            dtype=torch.uint8,
-                            device=device,
-                        )
-                        cur_ins_label[
-                            : seg_mask.shape[0], : seg_mask.shape[1]
-                        ] = seg_mask
-                        ins_label.append(cur_ins_label)
-                        ins_ind_label[label] = True
-                        grid_order.append(label)
-            ins_label = torch.stack(ins_label, 0)
-
-            ins_label_list.append(ins_label)
-            cate_label_list.append(cate_label)
-            ins_ind_label_list.append(ins_ind_label)
-            grid_order_list.append(grid_order)
-        return ins_label_list, cate_label_list, ins_ind_label_list, grid_order_list
+        return (
+            ins_masks,
+            cate_label_list,
+            ins_ind_label_list,
+            grid_order_list,
+            ins_index_list,
+        )
 
     def get_seg(self, cate_preds, kernel_preds, seg_pred, img_metas, cfg, rescale=None):
-        num_levels = len(cate_preds)
-        featmap_size = seg_pred.size()[-2:]
+        """Instance masks of a batch of images.
+
+        The heads run on the whole batch, the post-processing in
+        ``get_seg_single`` one image at a time, so the memory of the
+        candidate masks is that of one image whatever the batch size.
+
+        With ``mask_format="lazy"`` in the test config the masks are returned
+        as ``LazySegMasks`` at mask feature resolution, full resolution masks
+        are only computed for the instances that are accessed. With
+        ``mask_format="cropped"`` every mask is only resampled inside its box
+        and returned as ``CroppedSegMasks``. ``mask_format="band"`` returns
+        the same bool tensor as ``"dense"``, filled from the stride-4 masks
+        away from the boundaries and resampled only along them, see
+        ``band_upsample``.
+
+        With ``levels`` in the test config the predictions are those of the
+        given levels only, as ``forward(levels=...)`` returns them.
+
+        Args:
+            cate_preds (list[Tensor]): per level, category scores
+                (N, G, G, C) from ``forward(eval=True)``.
+            kernel_preds (list[Tensor]): per level, kernel predictions.
+            seg_pred (Tensor): mask features, shape (N, I, H, W).
+            img_metas (list[dict]): meta of every image.
+            cfg (dict): test config.
+
+        Returns:
+            list[tuple | None]: per image ``(seg_masks, cate_labels,
+                cate_scores)``, None when nothing is detected. ``seg_masks``
+                is a bool tensor (n, H, W) at the original image size, a
+                ``LazySegMasks`` or a ``CroppedSegMasks``.
+        """
+        mask_format = cfg.get("mask_format", "dense")
+        if mask_format not in ("dense", "lazy", "cropped", "band"):
+            raise ValueError("unknown mask_format {}".format(mask_format))
+        # the predictions are those of the levels run by forward
+        levels = cfg.get("levels")
+        if levels is None:
+            levels = list(range(len(self.seg_num_grids)))
 
         result_list = []
         for img_id in range(len(img_metas)):
-            cate_pred_list = [
-                cate_preds[i][img_id].view(-1, self.cate_out_channels).detach()
-                for i in range(num_levels)
-            ]
-            seg_pred_list = seg_pred[img_id, ...].unsqueeze(0)
+            cate_pred_list = torch.cat(
+                [
+                    cate_pred[img_id].reshape(-1, self.cate_out_channels)
+                    for cate_pred in cate_preds
+                ]
+            ).detach()
             kernel_pred_list = [
-                kernel_preds[i][img_id]
-                .permute(1, 2, 0)
-                .view(-1, self.kernel_out_channels)
-                .detach()
-                for i in range(num_levels)
+                kernel_pred[img_id : img_id + 1] for kernel_pred in kernel_preds
             ]
-            img_shape = img_metas[img_id]["img_shape"]
-            scale_factor = img_metas[img_id]["scale_factor"]
-            ori_shape = img_metas[img_id]["ori_shape"]
-
-            cate_pred_list = torch.cat(cate_pred_list, dim=0)
-            kernel_pred_list = torch.cat(kernel_pred_list, dim=0)
-
             result = self.get_seg_single(
                 cate_pred_list,
-                seg_pred_list,
+                seg_pred[img_id].detach(),
                 kernel_pred_list,
-                featmap_size,
-                img_shape,
-                ori_shape,
-                scale_factor,
+                img_metas[img_id],
+                levels,
                 cfg,
-                rescale,
             )
             result_list.append(result)
         return result_list
 
     def get_seg_single(
-        self,
-        cate_preds,
-        seg_preds,
-        kernel_preds,
-        featmap_size,
-        img_shape,
-        ori_shape,
-        scale_factor,
-        cfg,
-        rescale=False,
-        debug=False,
+        self, cate_preds, seg_preds, kernel_preds, img_meta, levels, cfg
     ):
-        assert len(cate_preds) == len(kernel_preds)
-
-        # overall info.
-        h, w, _ = img_shape
-        upsampled_size_out = (featmap_size[0] * 4, featmap_size[1] * 4)
+        """``get_seg`` of one image.
+
+        Args:
+            cate_preds (Tensor): scores of the level-concatenated grids,
+                shape (S, C).
+            seg_preds (Tensor): mask features of the image, shape (I, H, W).
+            kernel_preds (list[Tensor]): per level, kernel predictions of the
+                image with a batch dimension of one.
+            img_meta (dict): meta of the image.
+            levels (list[int]): indices of the levels of the predictions.
+            cfg (dict): test config.
+        """
+        mask_format = cfg.get("mask_format", "dense")
+        featmap_size = seg_preds.size()[-2:]
+        seg_feats = seg_preds.reshape(seg_preds.size(0), -1)
 
         # process.
         inds = cate_preds > cfg["score_thr"]
@@ -530,88 +900,155 @@ class SOLOv2Head(nn.Module):
         if len(cate_scores) == 0:
             return None
 
-        # cate_labels & kernel_preds
+        # several classes may share a cell
         inds = inds.nonzero()
-        cate_labels = inds[:, 1]
-        kernel_preds = kernel_preds[inds[:, 0]]
+        cells, cate_labels = inds[:, 0], inds[:, 1]
+        max_kernels = cfg.get("max_kernels_before_conv")
+        if max_kernels is not None:
+            # the category scores are points_nms peaks, keep the best before
+            # their masks are computed
+            keep = torch.argsort(cate_scores, descending=True)[:max_kernels]
+            cate_scores = cate_scores[keep]
+            cate_labels = cate_labels[keep]
+            cells = cells[keep]
+        cells, cand_cells = torch.unique(cells, return_inverse=True)
+
+        # mask encoding, once per cell.
+        kernels = self.gather_kernels(kernel_preds, [cells], levels)[0].detach()
 
         # trans vector.
-        size_trans = cate_labels.new_tensor(self.seg_num_grids).pow(2).cumsum(0)
-        strides = kernel_preds.new_ones(size_trans[-1])
-
-        n_stage = len(self.seg_num_grids)
-        strides[: size_trans[0]] *= self.strides[0]
-        for ind_ in range(1, n_stage):
-            strides[size_trans[ind_ - 1] : size_trans[ind_]] *= self.strides[ind_]
-        strides = strides[inds[:, 0]]
-
-        # mask encoding.
-        I, N = kernel_preds.shape
-        kernel_preds = kernel_preds.view(I, N, 1, 1)
-        seg_preds = F.conv2d(seg_preds, kernel_preds, stride=1).squeeze(0).sigmoid()
-        # mask.
-        seg_masks = seg_preds > cfg["mask_thr"]
-        sum_masks = seg_masks.sum((1, 2)).float()
+        strides = torch.cat(
+            [
+                cate_scores.new_full((self.seg_num_grids[idx] ** 2,), self.strides[idx])
+                for idx in levels
+            ]
+        )
+
+        # mask, the size filter and the mask score only depend on the cell, the
+        # masks are gathered per candidate after the nms_pre cut
+        mask_chunk = cfg.get("mask_chunk")
+        if mask_chunk is None:
+            cell_preds = kernels.mm(seg_feats).sigmoid_()
+            cell_masks = cell_preds > cfg["mask_thr"]
+            cell_sums = cell_masks.sum(1).float()
+            cell_scores = (cell_preds * cell_masks.float()).sum(1) / cell_sums
+        else:
+            cell_sums, cell_scores = self.mask_stats(
+                kernels, seg_feats, cfg["mask_thr"], mask_chunk
+            )
+        cell_keep = cell_sums > strides[cells]
 
         # filter.
-        keep = sum_masks > strides
+        keep = cell_keep[cand_cells]
         if keep.sum() == 0:
             return None
-
-        seg_masks = seg_masks[keep, ...]
-        seg_preds = seg_preds[keep, ...]
-        sum_masks = sum_masks[keep]
+        cand_cells = cand_cells[keep]
         cate_scores = cate_scores[keep]
         cate_labels = cate_labels[keep]
 
         # mask scoring.
-        seg_scores = (seg_preds * seg_masks.float()).sum((1, 2)) / sum_masks
-        cate_scores *= seg_scores
+        cate_scores *= cell_scores[cand_cells]
 
         # sort and keep top nms_pre
-        sort_inds = torch.argsort(cate_scores, descending=True)
-        if len(sort_inds) > cfg["nms_pre"]:
-            sort_inds = sort_inds[: cfg["nms_pre"]]
-        seg_masks = seg_masks[sort_inds, :, :]
-        seg_preds = seg_preds[sort_inds, :, :]
-        sum_masks = sum_masks[sort_inds]
+        sort_inds = torch.argsort(cate_scores, descending=True)[: cfg["nms_pre"]]
+        cand_cells = cand_cells[sort_inds]
         cate_scores = cate_scores[sort_inds]
         cate_labels = cate_labels[sort_inds]
 
+        if mask_chunk is not None:
+            # only the masks of the cells left after the nms_pre cut are kept
+            cells_left, cand_cells = torch.unique(cand_cells, return_inverse=True)
+            cell_sums = cell_sums[cells_left]
+            cell_preds = kernels[cells_left].mm(seg_feats).sigmoid_()
+            cell_masks = cell_preds > cfg["mask_thr"]
+
         # Matrix NMS
-        cate_scores = matrix_nms(
-            seg_masks,
+        nms_kwargs = dict(kernel=cfg["kernel"], sigma=cfg["sigma"])
+        if cfg.get("nms_per_class", False):
+            nms = matrix_nms_sparse
+        elif cfg.get("nms_block_size") is not None:
+            nms = matrix_nms_tiled
+            nms_kwargs["block_size"] = cfg["nms_block_size"]
+        else:
+            nms = matrix_nms
+        cate_scores = nms(
+            cell_masks[cand_cells].view(-1, *featmap_size),
             cate_labels,
             cate_scores,
-            kernel=cfg["kernel"],
-            sigma=cfg["sigma"],
-            sum_masks=sum_masks,
+            sum_masks=cell_sums[cand_cells],
+            **nms_kwargs,
         )
 
         # filter.
         keep = cate_scores >= cfg["update_thr"]
         if keep.sum() == 0:
             return None
-        seg_preds = seg_preds[keep, :, :]
+        cand_cells = cand_cells[keep]
         cate_scores = cate_scores[keep]
         cate_labels = cate_labels[keep]
 
         # sort and keep top_k
-        sort_inds = torch.argsort(cate_scores, descending=True)
-        if len(sort_inds) > cfg["max_per_img"]:
-            sort_inds = sort_inds[: cfg["max_per_img"]]
-        seg_preds = seg_preds[sort_inds, :, :]
+        sort_inds = torch.argsort(cate_scores, descending=True)[: cfg["max_per_img"]]
+        seg_preds = cell_preds[cand_cells[sort_inds]].view(-1, *featmap_size)
         cate_scores = cate_scores[sort_inds]
         cate_labels = cate_labels[sort_inds]
 
-        seg_preds = F.interpolate(
-            seg_preds.unsqueeze(0),
-            size=upsampled_size_out,
-            mode="bilinear",
-            align_corners=False,
-        )[:, :, :h, :w]
-        seg_masks = F.interpolate(
-            seg_preds, size=ori_shape[:2], mode="bilinear", align_corners=False
-        ).squeeze(0)
-        seg_masks = seg_masks > cfg["mask_thr"]
+        upsampled_size_out = (featmap_size[0] * 4, featmap_size[1] * 4)
+        if mask_format == "band":
+            seg_masks = band_upsample(
+                seg_preds,
+                upsampled_size_out,
+                img_meta["img_shape"],
+                img_meta["ori_shape"],
+                cfg["mask_thr"],
+            )
+        elif mask_format == "cropped":
+            seg_masks = CroppedSegMasks(
+                *crop_upsample(
+                    seg_preds,
+                    upsampled_size_out,
+                    img_meta["img_shape"],
+                    img_meta["ori_shape"],
+                    cfg["mask_thr"],
+                ),
+                img_meta["ori_shape"],
+            )
+        else:
+            seg_masks = LazySegMasks(
+                seg_preds,
+                upsampled_size_out,
+                img_meta["img_shape"],
+                img_meta["ori_shape"],
+                cfg["mask_thr"],
+            )
+            if mask_format == "dense":
+                seg_masks = seg_masks.upsample(seg_preds)
         return seg_masks, cate_labels, cate_scores
+
+    def mask_stats(self, kernels, seg_feats, mask_thr, chunk):
+        """Foreground area and mask score of the mask of every kernel.
+
+        The masks are computed ``chunk`` kernels at a time and only their
+        statistics are kept, so the memory does not grow with the number of
+        kernels.
+
+        Args:
+            kernels (Tensor): kernels of shape (P, I).
+            seg_feats (Tensor): mask features, shape (I, H * W).
+            mask_thr (float): mask threshold.
+            chunk (int): kernels per step.
+
+        Returns:
+            tuple(Tensor): areas and mask scores of shape (P).
+        """
+        sum_masks = seg_feats.new_empty(len(kernels))
+        seg_scores = seg_feats.new_empty(len(kernels))
+        for start in range(0, len(kernels), chunk):
+            seg_preds = kernels[start : start + chunk].mm(seg_feats).sigmoid_()
+            seg_masks = seg_preds > mask_thr
+            chunk_sums = seg_masks.sum(1).float()
+            sum_masks[start : start + chunk] = chunk_sums
+            seg_scores[start : start + chunk] = (
+                seg_preds.masked_fill_(~seg_masks, 0).sum(1) / chunk_sums
+            )
+        return sum_masks, seg_scores
@@ -0,0 +1,344 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+import cv2
+
+
+def mass_centers(gt_masks):
+    """Mass centers of a stack of binary masks.
+
+    Gives the same values as calling ``scipy.ndimage.center_of_mass`` on every
+    mask, but reduces all masks in one pass.
+
+    Args:
+        gt_masks (ndarray): shape (n, h, w), binary masks.
+
+    Returns:
+        tuple(ndarray): centers of shape (n, 2) as (center_h, center_w) in
+            float64, and the pixel count of every mask, shape (n).
+    """
+    gt_masks = np.asarray(gt_masks)
+    n, h, w = gt_masks.shape
+    row_sums = gt_masks.sum(axis=2, dtype=np.int64)
+    col_sums = gt_masks.sum(axis=1, dtype=np.int64)
+    areas = row_sums.sum(axis=1)
+    centers = np.zeros((n, 2), dtype=np.float64)
+    nonzero = areas > 0
+    centers[nonzero, 0] = (row_sums[nonzero] @ np.arange(h, dtype=np.float64)) / areas[
+        nonzero
+    ]
+    centers[nonzero, 1] = (col_sums[nonzero] @ np.arange(w, dtype=np.float64)) / areas[
+        nonzero
+    ]
+    return centers, areas
+
+
+def rescale_masks(gt_masks, scale):
+    """Rescale a stack of masks, same as ``imrescale`` on every mask.
+
+    All masks share one output buffer instead of being rescaled and copied
+    into a fresh tensor per grid cell.
+
+    Args:
+        gt_masks (ndarray): shape (n, h, w), uint8 masks.
+        scale (float): scaling factor.
+
+    Returns:
+        ndarray: rescaled masks of shape (n, new_h, new_w).
+    """
+    gt_masks = np.asarray(gt_masks)
+    n, h, w = gt_masks.shape
+    # rounded as rescale_size in data.imgutils, which this module does not
+    # import: data.piplines imports this module for SOLOv2Target
+    new_size = (int(w * float(scale) + 0.5), int(h * float(scale) + 0.5))
+    out = np.empty((n, new_size[1], new_size[0]), dtype=gt_masks.dtype)
+    # single channel resizes take the SIMD path of cv2, packing the masks as
+    # channels of one image is several times slower
+    for i in range(n):
+        cv2.resize(gt_masks[i], new_size, dst=out[i], interpolation=cv2.INTER_LINEAR)
+    return out
+
+
+def solov2_assign_grids(
+    gt_bboxes,
+    gt_labels,
+    centers,
+    valid,
+    upsampled_size,
+    num_grids,
+    scale_ranges,
+    sigma,
+):
+    """Assign all instances of an image to SOLOv2 grid cells at once.
+
+    Instances are picked per level by the square root of their box area, the
+    center region is the mass center grown by ``sigma`` times the box size and
+    clipped to the 3x3 neighbourhood of the center cell. When two instances
+    cover the same cell the later one wins, exactly like the per-instance
+    loop this replaces.
+
+    Args:
+        gt_bboxes (Tensor): shape (n, 4), boxes in the padded input frame.
+        gt_labels (Tensor): shape (n), category labels, 0 is background.
+        centers (Tensor): shape (n, 2), float64 mass centers (h, w).
+        valid (Tensor): shape (n), False for instances with an empty mask.
+        upsampled_size (tuple[int]): (h, w) of the frame the grids divide.
+        num_grids (list[int]): grid number of every level.
+        scale_ranges (list[tuple]): instance scale range of every level.
+        sigma (float): center region scale.
+
+    Returns:
+        list[tuple]: per level ``(cate_label, ins_ind_label, grid_order,
+            ins_index)``. ``grid_order`` holds the flattened positive cells in
+            assignment order and ``ins_index`` the instance of each of them.
+    """
+    device = gt_labels.device
+    gt_areas = torch.sqrt(
+        (gt_bboxes[:, 2] - gt_bboxes[:, 0]) * (gt_bboxes[:, 3] - gt_bboxes[:, 1])
+    )
+    half_ws = 0.5 * (gt_bboxes[:, 2] - gt_bboxes[:, 0]) * sigma
+    half_hs = 0.5 * (gt_bboxes[:, 3] - gt_bboxes[:, 1]) * sigma
+
+    centers = centers.to(device)
+    center_h = centers[:, 0]
+    center_w = centers[:, 1]
+    # the box edges are computed against float32 half sizes, as before
+    center_h32 = center_h.to(half_hs.dtype)
+    center_w32 = center_w.to(half_ws.dtype)
+
+    offsets = torch.tensor([-1, 0, 1], device=device)
+    offset_h = offsets.view(3, 1).expand(3, 3).reshape(-1)
+    offset_w = offsets.view(1, 3).expand(3, 3).reshape(-1)
+
+    targets = []
+    for (lower_bound, upper_bound), num_grid in zip(scale_ranges, num_grids):
+        hit = (gt_areas >= lower_bound) & (gt_areas <= upper_bound) & valid
+        hit_indices = hit.nonzero().flatten()
+        if len(hit_indices) == 0:
+            empty = torch.zeros([0], dtype=torch.int64, device=device)
+            cate_label, ins_ind_label = grid_labels(num_grid, empty, empty, gt_labels)
+            targets.append((cate_label, ins_ind_label, empty, empty))
+            continue
+
+        grid_size = 1.0 / num_grid
+        c_h = center_h[hit_indices]
+        c_w = center_w[hit_indices]
+        coord_h = ((c_h / upsampled_size[0]) // grid_size).long()
+        coord_w = ((c_w / upsampled_size[1]) // grid_size).long()
+
+        c_h32 = center_h32[hit_indices]
+        c_w32 = center_w32[hit_indices]
+        half_h = half_hs[hit_indices]
+        half_w = half_ws[hit_indices]
+        top_box = (((c_h32 - half_h) / upsampled_size[0]) // grid_size).long()
+        down_box = (((c_h32 + half_h) / upsampled_size[0]) // grid_size).long()
+        left_box = (((c_w32 - half_w) / upsampled_size[1]) // grid_size).long()
+        right_box = (((c_w32 + half_w) / upsampled_size[1]) // grid_size).long()
+
+        top = torch.max(top_box.clamp(min=0), coord_h - 1)
+        down = torch.min(down_box.clamp(max=num_grid - 1), coord_h + 1)
+        left = torch.max(left_box.clamp(min=0), coord_w - 1)
+        right = torch.min(right_box.clamp(max=num_grid - 1), coord_w + 1)
+
+        # (num_ins, 9) candidate cells around every center, row-major
+        cell_h = coord_h[:, None] + offset_h[None, :]
+        cell_w = coord_w[:, None] + offset_w[None, :]
+        inside = (
+            (cell_h >= top[:, None])
+            & (cell_h <= down[:, None])
+            & (cell_w >= left[:, None])
+            & (cell_w <= right[:, None])
+        )
+        cells = cell_h * num_grid + cell_w
+        grid_order = cells[inside]
+        ins_index = hit_indices[:, None].expand_as(cells)[inside]
+
+        cate_label, ins_ind_label = grid_labels(
+            num_grid, grid_order, ins_index, gt_labels
+        )
+        targets.append((cate_label, ins_ind_label, grid_order, ins_index))
+    return targets
+
+
+def grid_fingerprint(num_grids, scale_ranges, sigma):
+    """The grid assignment settings as a string, equal for equal settings
+    whatever sequence types they are given in."""
+    return repr(
+        (
+            [int(num_grid) for num_grid in num_grids],
+            [tuple(scale_range) for scale_range in scale_ranges],
+            float(sigma),
+        )
+    )
+
+
+def grid_labels(num_grid, grid_order, ins_index, gt_labels):
+    """Category and positive-cell maps of one level from its grid orders.
+
+    Args:
+        num_grid (int): grid number of the level.
+        grid_order (Tensor): shape (p), flattened positive cells.
+        ins_index (Tensor): shape (p), instance of every positive cell.
+        gt_labels (Tensor): shape (n), category labels of the instances.
+
+    Returns:
+        tuple(Tensor): cate_label of shape (num_grid, num_grid) and
+            ins_ind_label of shape (num_grid ** 2).
+    """
+    device = gt_labels.device
+    cate_label = torch.zeros([num_grid, num_grid], dtype=torch.int64, device=device)
+    ins_ind_label = torch.zeros([num_grid**2], dtype=torch.bool, device=device)
+    if len(grid_order) == 0:
+        return cate_label, ins_ind_label
+
+    # later instances overwrite earlier ones on shared cells: keep the
+    # highest instance index of every cell
+    num_total = len(gt_labels)
+    keys, _ = torch.sort(grid_order * num_total + ins_index)
+    last = torch.ones_like(keys, dtype=torch.bool)
+    last[:-1] = (keys[1:] // num_total) != (keys[:-1] // num_total)
+    keys = keys[last]
+    cate_label.view(-1)[keys // num_total] = gt_labels[keys % num_total].long()
+    ins_ind_label[grid_order] = True
+    return cate_label, ins_ind_label
+
+
+class SOLOv2TargetCache(object):
+    """On-disk cache of per-image SOLOv2 training targets.
+
+    The targets of an image only depend on its annotation, the ``Resize`` scale
+    it was drawn at and the flip flag, so entries are keyed by
+    ``(img_id, scale_idx, flip)``. ``scale_idx`` only means something for the
+    ``Resize`` settings and annotation file it was drawn with, so entries are
+    stored under a directory named after a fingerprint of those and of the
+    head settings the assignment depends on. Every entry also records the
+    resized image shape, a hit whose shape differs from the image is treated
+    as a miss.
+
+    Every entry holds the stride-4 instance masks (``.npy``, memory-mapped on
+    read), the mass centers and the per-level grid orders computed for the
+    padded batch size of the step that wrote it. A later step with another
+    batch size reuses the masks and centers and only reassigns the grids.
+
+    Args:
+        root (str): cache directory.
+        num_grids (list[int]): grid number of every level.
+        scale_ranges (list[tuple]): instance scale range of every level.
+        sigma (float): center region scale.
+        output_stride (int): stride of the cached masks.
+        resize_cfg (dict | None): the ``Resize`` transform of the train
+            pipeline.
+        ann_file (str | None): annotation file of the train dataset, its
+            path, size and modification time are part of the fingerprint.
+    """
+
+    version = 2
+
+    def __init__(
+        self,
+        root,
+        num_grids,
+        scale_ranges,
+        sigma,
+        output_stride=4,
+        resize_cfg=None,
+        ann_file=None,
+    ):
+        self.num_grids = list(num_grids)
+        self.output_stride = output_stride
+        ann_stat = None
+        if ann_file is not None:
+            ann_file = os.path.abspath(ann_file)
+            if os.path.exists(ann_file):
+                stat = os.stat(ann_file)
+                ann_stat = (stat.st_size, stat.st_mtime_ns)
+        fingerprint = repr(
+            (
+                self.version,
+                self.num_grids,
+                [tuple(scale_range) for scale_range in scale_ranges],
+                float(sigma),
+                output_stride,
+                sorted((resize_cfg or {}).items()),
+                ann_file,
+                ann_stat,
+            )
+        )
+        self.root = os.path.join(
+            root, hashlib.sha1(fingerprint.encode()).hexdigest()[:16]
+        )
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def key(img_meta):
+        """Cache key of an image, None when its meta can not identify it."""
+        img_id = img_meta.get("img_id")
+        scale_idx = img_meta.get("scale_idx")
+        if img_id is None or scale_idx is None or "img_shape" not in img_meta:
+            return None
+        return int(img_id), int(scale_idx), bool(img_meta.get("flip", False))
+
+    def _path(self, key):
+        return os.path.join(self.root, "{}_{}_{}".format(key[0], key[1], int(key[2])))
+
+    def get(self, key, num_ins, img_shape):
+        """Load an entry.
+
+        Returns:
+            dict | None: ``masks`` (memory-mapped, (n, h, w)), ``centers``,
+                ``areas``, ``upsampled_size`` and the per-level
+                ``grid_orders`` and ``ins_indices``; None on a miss or when
+                the entry does not hold ``num_ins`` instances of an image
+                resized to ``img_shape``.
+        """
+        path = self._path(key)
+        if not os.path.exists(path + ".npz"):
+            return None
+        with np.load(path + ".npz") as meta:
+            meta = dict(meta)
+        if len(meta["centers"]) != num_ins:
+            return None
+        if tuple(meta["img_shape"].tolist()) != tuple(img_shape[:2]):
+            return None
+        splits = np.cumsum(meta["level_sizes"])[:-1]
+        return dict(
+            masks=np.load(path + ".npy", mmap_mode="r"),
+            centers=meta["centers"],
+            areas=meta["areas"],
+            upsampled_size=tuple(meta["upsampled_size"].tolist()),
+            grid_orders=np.split(meta["grid_orders"], splits),
+            ins_indices=np.split(meta["ins_indices"], splits),
+        )
+
+    def put(
+        self,
+        key,
+        img_shape,
+        masks,
+        centers,
+        areas,
+        upsampled_size,
+        grid_orders,
+        ins_indices,
+    ):
+        """Store an entry, the files are renamed into place once written."""
+        path = self._path(key)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp + ".npy", "wb") as f:
+            np.save(f, np.ascontiguousarray(masks, dtype=np.uint8))
+        with open(tmp + ".npz", "wb") as f:
+            np.savez(
+                f,
+                img_shape=np.array(img_shape[:2], dtype=np.int64),
+                centers=centers,
+                areas=areas,
+                upsampled_size=np.array(upsampled_size, dtype=np.int64),
+                level_sizes=np.array([len(g) for g in grid_orders], dtype=np.int64),
+                grid_orders=np.concatenate(grid_orders).astype(np.int64),
+                ins_indices=np.concatenate(ins_indices).astype(np.int64),
+            )
+        # the meta file marks a complete entry, so it goes last
+        os.replace(tmp + ".npy", path + ".npy")
+        os.replace(tmp + ".npz", path + ".npz")
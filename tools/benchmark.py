@@ -0,0 +1,1433 @@
+"""
+Micro benchmarks for the SOLOv2 training and inference hot spots.
+
+run from the repository root, e.g.
+    python tools/benchmark.py targets
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import pycocotools.mask as mask_util
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data.config import cfg, resnet18_backbone
+from modules.backbone import resnet18, resnet34, resnet50
+from modules.solov2 import SOLOV2
+from modules.mask_feat_head import MaskFeatHead
+from modules.solov2_head import SOLOv2Head
+from modules.misc import matrix_nms, matrix_nms_sparse, matrix_nms_tiled
+from modules.rle import encode_masks
+from modules.seg_masks import (
+    CroppedSegMasks,
+    LazySegMasks,
+    band_upsample,
+    crop_upsample,
+)
+from modules.solov2_target import SOLOv2TargetCache
+
+
+def build_head(**kwargs):
+    # same head settings as SOLOV2
+    cfg = dict(
+        num_classes=81,
+        in_channels=256,
+        seg_feat_channels=256,
+        stacked_convs=2,
+        strides=[8, 8, 16, 32, 32],
+        scale_ranges=((1, 56), (28, 112), (56, 224), (112, 448), (224, 896)),
+        num_grids=[40, 36, 24, 16, 12],
+        ins_out_channels=128,
+    )
+    cfg.update(kwargs)
+    return SOLOv2Head(**cfg)
+
+
+def timeit(func, repeat=5, warmup=1):
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def random_instances(num_ins, img_h=512, img_w=768, seed=0):
+    """Random box-shaped instances with ragged masks, like crowded COCO images."""
+    rng = np.random.RandomState(seed)
+    masks = np.zeros((num_ins, img_h, img_w), dtype=np.uint8)
+    boxes = np.zeros((num_ins, 4), dtype=np.float32)
+    for i in range(num_ins):
+        w = rng.randint(8, img_w // 2)
+        h = rng.randint(8, img_h // 2)
+        x1 = rng.randint(0, img_w - w)
+        y1 = rng.randint(0, img_h - h)
+        masks[i, y1 : y1 + h, x1 : x1 + w] = rng.rand(h, w) > 0.2
+        boxes[i] = (x1, y1, x1 + w - 1, y1 + h - 1)
+    labels = rng.randint(1, 81, size=num_ins)
+    return torch.from_numpy(boxes), torch.from_numpy(labels), masks
+
+
+def reference_target_single(
+    head, gt_bboxes_raw, gt_labels_raw, gt_masks_raw, mask_feat_size
+):
+    """The per-instance, per-cell target loop SOLOv2Head used before."""
+    from scipy import ndimage
+    from data.imgutils import imrescale
+
+    device = gt_labels_raw.device
+    gt_areas = torch.sqrt(
+        (gt_bboxes_raw[:, 2] - gt_bboxes_raw[:, 0])
+        * (gt_bboxes_raw[:, 3] - gt_bboxes_raw[:, 1])
+    )
+    ins_label_list = []
+    cate_label_list = []
+    ins_ind_label_list = []
+    grid_order_list = []
+    for (lower_bound, upper_bound), num_grid in zip(
+        head.scale_ranges, head.seg_num_grids
+    ):
+        hit_indices = (
+            ((gt_areas >= lower_bound) & (gt_areas <= upper_bound)).nonzero().flatten()
+        )
+        ins_label = []
+        grid_order = []
+        cate_label = torch.zeros([num_grid, num_grid], dtype=torch.int64, device=device)
+        ins_ind_label = torch.zeros([num_grid**2], dtype=torch.bool, device=device)
+        if len(hit_indices) == 0:
+            ins_label_list.append(
+                torch.zeros(
+                    [0, mask_feat_size[0], mask_feat_size[1]], dtype=torch.uint8
+                )
+            )
+            cate_label_list.append(cate_label)
+            ins_ind_label_list.append(ins_ind_label)
+            grid_order_list.append([])
+            continue
+        gt_bboxes = gt_bboxes_raw[hit_indices]
+        gt_labels = gt_labels_raw[hit_indices]
+        gt_masks = gt_masks_raw[hit_indices.cpu().numpy(), ...]
+        half_ws = 0.5 * (gt_bboxes[:, 2] - gt_bboxes[:, 0]) * head.sigma
+        half_hs = 0.5 * (gt_bboxes[:, 3] - gt_bboxes[:, 1]) * head.sigma
+        upsampled_size = (mask_feat_size[0] * 4, mask_feat_size[1] * 4)
+        for seg_mask, gt_label, half_h, half_w in zip(
+            gt_masks, gt_labels, half_hs, half_ws
+        ):
+            if seg_mask.sum() == 0:
+                continue
+            center_h, center_w = ndimage.center_of_mass(seg_mask)
+            coord_w = int((center_w / upsampled_size[1]) // (1.0 / num_grid))
+            coord_h = int((center_h / upsampled_size[0]) // (1.0 / num_grid))
+            top_box = max(
+                0, int(((center_h - half_h) / upsampled_size[0]) // (1.0 / num_grid))
+            )
+            down_box = min(
+                num_grid - 1,
+                int(((center_h + half_h) / upsampled_size[0]) // (1.0 / num_grid)),
+            )
+            left_box = max(
+                0, int(((center_w - half_w) / upsampled_size[1]) // (1.0 / num_grid))
+            )
+            right_box = min(
+                num_grid - 1,
+                int(((center_w + half_w) / upsampled_size[1]) // (1.0 / num_grid)),
+            )
+            top = max(top_box, coord_h - 1)
+            down = min(down_box, coord_h + 1)
+            left = max(coord_w - 1, left_box)
+            right = min(right_box, coord_w + 1)
+            cate_label[top : (down + 1), left : (right + 1)] = gt_label
+            seg_mask = torch.Tensor(imrescale(seg_mask, scale=1.0 / 4))
+            for i in range(top, down + 1):
+                for j in range(left, right + 1):
+                    cur_ins_label = torch.zeros(
+                        [mask_feat_size[0], mask_feat_size[1]],
+                        dtype=torch.uint8,
+                        device=device,
+                    )
+                    cur_ins_label[: seg_mask.shape[0], : seg_mask.shape[1]] = seg_mask
+                    ins_label.append(cur_ins_label)
+                    ins_ind_label[int(i * num_grid + j)] = True
+                    grid_order.append(int(i * num_grid + j))
+        ins_label_list.append(torch.stack(ins_label, 0))
+        cate_label_list.append(cate_label)
+        ins_ind_label_list.append(ins_ind_label)
+        grid_order_list.append(grid_order)
+    return ins_label_list, cate_label_list, ins_ind_label_list, grid_order_list
+
+
+def bench_targets(args):
+    head = build_head()
+    cache_dir = tempfile.mkdtemp()
+    target_cache = SOLOv2TargetCache(
+        cache_dir, head.seg_num_grids, head.scale_ranges, head.sigma
+    )
+    feat_size = torch.Size((512 // 4, 768 // 4))
+    print(
+        "instances | loop (ms/img) | vectorized (ms/img) | speedup "
+        "| cached (ms/img) | per-cell masks (MB) | compact masks (MB)"
+    )
+    for num_ins in (1, 5, 10, 20, 50, 100):
+        boxes, labels, masks = random_instances(num_ins)
+        img_meta = dict(
+            img_id=num_ins, scale_idx=0, flip=False, img_shape=(512, 768, 3)
+        )
+        t_ref = timeit(
+            lambda: reference_target_single(head, boxes, labels, masks, feat_size),
+            repeat=args.repeat,
+        )
+        head.target_cache = None
+        t_new = timeit(
+            lambda: head.solov2_target_single(
+                boxes, labels, masks, mask_feat_size=feat_size
+            ),
+            repeat=args.repeat,
+        )
+        # the warmup call fills the cache, the timed ones read it
+        head.target_cache = target_cache
+        t_cached = timeit(
+            lambda: head.solov2_target_single(
+                boxes, labels, masks, img_meta, mask_feat_size=feat_size
+            ),
+            repeat=args.repeat,
+        )
+        head.target_cache = None
+        ins_labels = reference_target_single(head, boxes, labels, masks, feat_size)[0]
+        ins_masks, _, _, _, ins_index = head.solov2_target_single(
+            boxes, labels, masks, mask_feat_size=feat_size
+        )
+        per_cell = sum(t.numel() * t.element_size() for t in ins_labels)
+        compact = ins_masks.numel() * ins_masks.element_size() + sum(
+            t.numel() * t.element_size() for t in ins_index
+        )
+        print(
+            "{:9d} | {:13.1f} | {:19.1f} | {:6.1f}x | {:15.1f} "
+            "| {:19.1f} | {:18.1f}".format(
+                num_ins,
+                t_ref * 1000,
+                t_new * 1000,
+                t_ref / t_new,
+                t_cached * 1000,
+                per_cell / 2**20,
+                compact / 2**20,
+            )
+        )
+    shutil.rmtree(cache_dir)
+
+
+def reference_dynamic_conv(kernel_preds, ins_pred, grid_order_list):
+    """The per-level, per-image conv2d loop SOLOv2Head.loss used before."""
+    import torch.nn.functional as F
+
+    ins_pred_list = []
+    for kernel_preds_level, grid_orders_level in zip(
+        kernel_preds, zip(*grid_order_list)
+    ):
+        b_mask_pred = []
+        for idx, (kernel_pred, grid_order) in enumerate(
+            zip(kernel_preds_level, grid_orders_level)
+        ):
+            kernel_pred = kernel_pred.view(kernel_pred.shape[0], -1)[:, grid_order]
+            if kernel_pred.size()[-1] == 0:
+                continue
+            cur_ins_pred = ins_pred[idx, ...]
+            H, W = cur_ins_pred.shape[-2:]
+            N, I = kernel_pred.shape
+            kernel_pred = kernel_pred.permute(1, 0).view(I, -1, 1, 1)
+            b_mask_pred.append(
+                F.conv2d(cur_ins_pred.unsqueeze(0), kernel_pred).view(-1, H, W)
+            )
+        if len(b_mask_pred) > 0:
+            ins_pred_list.append(torch.cat(b_mask_pred, 0))
+    return ins_pred_list
+
+
+def bench_dynamic_conv(args):
+    head = build_head()
+    feat_h, feat_w = 512 // 4, 768 // 4
+    level_starts = np.cumsum([0] + [g**2 for g in head.seg_num_grids[:-1]])
+    print("imgs | positives | loop fwd+bwd (ms) | batched fwd+bwd (ms) | speedup")
+    for num_imgs, num_ins in ((2, 5), (2, 20), (4, 20), (8, 20), (8, 50)):
+        grid_order_list = []
+        for img in range(num_imgs):
+            boxes, labels, masks = random_instances(
+                num_ins, feat_h * 4, feat_w * 4, seed=img
+            )
+            grid_order_list.append(
+                head.solov2_target_single(
+                    boxes, labels, masks, mask_feat_size=(feat_h, feat_w)
+                )[3]
+            )
+        img_cells = [
+            torch.cat([g + int(s) for g, s in zip(grid_orders, level_starts)])
+            for grid_orders in grid_order_list
+        ]
+        kernel_preds = [
+            torch.randn(num_imgs, 128, g, g, requires_grad=True)
+            for g in head.seg_num_grids
+        ]
+        ins_pred = torch.randn(num_imgs, 128, feat_h, feat_w, requires_grad=True)
+
+        def loop():
+            masks = reference_dynamic_conv(kernel_preds, ins_pred, grid_order_list)
+            torch.cat([m.flatten(1) for m in masks]).sigmoid().sum().backward()
+
+        def batched():
+            masks = head.dynamic_conv(
+                head.gather_kernels(kernel_preds, img_cells), ins_pred
+            )
+            masks.sigmoid().sum().backward()
+
+        t_loop = timeit(loop, repeat=args.repeat)
+        t_batched = timeit(batched, repeat=args.repeat)
+        print(
+            "{:4d} | {:9d} | {:17.1f} | {:20.1f} | {:6.2f}x".format(
+                num_imgs,
+                sum(len(cells) for cells in img_cells),
+                t_loop * 1000,
+                t_batched * 1000,
+                t_loop / t_batched,
+            )
+        )
+
+
+def casia_dataset(pipeline):
+    """The bundled casia-SPT_val annotations with the given pipeline."""
+    from data.config import casia_SPT_val, process_funcs_dict
+    from data.coco import CocoDataset
+
+    transforms = []
+    for transform in pipeline:
+        transform = transform.copy()
+        transforms.append(process_funcs_dict[transform.pop("type")](**transform))
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return CocoDataset(
+        ann_file=casia_SPT_val.train_info,
+        pipeline=transforms,
+        img_prefix=casia_SPT_val.trainimg_prefix,
+        data_root=os.path.join(root, casia_SPT_val.train_prefix),
+    )
+
+
+def _rss_kb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1])
+
+
+def loss_peak_mb(head, img_shape, gt_bboxes, gt_labels, img_metas, gt_targets):
+    """Peak resident memory of loss_ins forward + backward above the memory
+    held before it, Linux only (resets VmHWM through /proc/self/clear_refs).
+
+    Run with MALLOC_MMAP_THRESHOLD_=65536 so freed tensors go back to the
+    system instead of staying in the malloc heap.
+    """
+    num_imgs, _, img_h, img_w = img_shape
+    cate_preds = [torch.randn(num_imgs, 80, g, g) for g in head.seg_num_grids]
+    kernel_preds = [
+        torch.randn(num_imgs, 128, g, g, requires_grad=True) for g in head.seg_num_grids
+    ]
+    ins_pred = torch.randn(num_imgs, 128, img_h // 4, img_w // 4, requires_grad=True)
+    before = _rss_kb("VmRSS")
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    losses = head.loss(
+        cate_preds,
+        kernel_preds,
+        ins_pred,
+        gt_bboxes,
+        gt_labels,
+        None,
+        img_metas,
+        gt_targets=gt_targets,
+    )
+    losses["loss_ins"].backward()
+    return (_rss_kb("VmHWM") - before) / 1024
+
+
+def bench_ins_loss_memory(args):
+    from data.collate import collate
+    from data.config import cfg, process_funcs_dict
+    from data.data_container import DataContainer
+
+    head = build_head()
+    target_keys = (
+        "ins_labels",
+        "cate_labels",
+        "ins_ind_labels",
+        "grid_orders",
+        "ins_indices",
+        "gt_centers",
+        "gt_areas",
+    )
+    modes = [
+        ("all at once", None, None),
+        ("chunk 16", None, 16),
+        ("cap 64, chunk 16", 64, 16),
+    ]
+
+    def run(batches, title):
+        peaks = {name: [] for name, _, _ in modes}
+        max_pos = 0
+        for data in batches:
+            gt_targets = {key: data[key].data[0] for key in target_keys}
+            max_pos = max(
+                max_pos, max(len(torch.cat(g)) for g in gt_targets["grid_orders"])
+            )
+            for name, max_ins_per_img, ins_loss_chunk in modes:
+                head.max_ins_per_img = max_ins_per_img
+                head.ins_loss_chunk = ins_loss_chunk
+                peaks[name].append(
+                    loss_peak_mb(
+                        head,
+                        data["img"].data[0].shape,
+                        data["gt_bboxes"].data[0],
+                        data["gt_labels"].data[0],
+                        data["img_metas"].data[0],
+                        gt_targets,
+                    )
+                )
+        print(
+            "{}, {} batches of {}, at most {} positives per image".format(
+                title, len(peaks[modes[0][0]]), args.batch, max_pos
+            )
+        )
+        print("mode             | mean peak (MB) | max peak (MB)")
+        for name, _, _ in modes:
+            print(
+                "{:16s} | {:14.1f} | {:13.1f}".format(
+                    name, np.mean(peaks[name]), np.max(peaks[name])
+                )
+            )
+
+    np.random.seed(0)
+    dataset = casia_dataset(cfg.train_pipeline)
+    run(
+        (
+            collate(
+                [dataset[i] for i in range(start, start + args.batch)],
+                samples_per_gpu=args.batch,
+            )
+            for start in range(0, len(dataset) - args.batch + 1, args.batch)
+        ),
+        "casia-SPT_val",
+    )
+
+    # crowded images, as in COCO crowd scenes
+    target_transform = process_funcs_dict["SOLOv2Target"](**cfg.grid_cfg)
+
+    def crowded(num_ins, seed):
+        boxes, labels, masks = random_instances(num_ins, seed=seed)
+        results = target_transform(
+            dict(
+                img=np.zeros((512, 768, 3), dtype=np.float32),
+                gt_bboxes=boxes.numpy(),
+                gt_labels=labels.numpy(),
+                gt_masks=masks,
+                pad_shape=(512, 768, 3),
+                img_shape=(512, 768, 3),
+            )
+        )
+        results = process_funcs_dict["DefaultFormatBundle"]()(results)
+        results["img_metas"] = DataContainer(
+            dict(
+                pad_shape=results["pad_shape"],
+                grid_fingerprint=results.pop("grid_fingerprint"),
+            ),
+            cpu_only=True,
+        )
+        return results
+
+    for num_ins in (30, 100):
+        run(
+            (
+                collate(
+                    [
+                        crowded(num_ins, seed)
+                        for seed in range(start, start + args.batch)
+                    ],
+                    samples_per_gpu=args.batch,
+                )
+                for start in range(0, 4 * args.batch, args.batch)
+            ),
+            "{} random instances per image".format(num_ins),
+        )
+
+
+def bench_focal_loss(args):
+    # the category loss on flatten_cate_preds, COCO grids (3872 cells per image);
+    # the memory columns need MALLOC_MMAP_THRESHOLD_=65536, see loss_peak_mb
+    from focal_loss.focal_loss import FocalLoss as SoftmaxFocalLoss
+    from modules.focal_loss import py_sigmoid_focal_loss, sigmoid_focal_loss
+
+    head = build_head()
+    num_cells = sum(g**2 for g in head.seg_num_grids)
+    softmax_focal_loss = SoftmaxFocalLoss(gamma=2.0, reduction="mean", ignore_index=80)
+    print(
+        "imgs | softmax + FocalLoss (ms, MB) | autograd sigmoid (ms, MB) "
+        "| fused sigmoid (ms, MB)"
+    )
+    for num_imgs in (2, 8, 16, 32):
+        pred = torch.randn(num_imgs * num_cells, 80, requires_grad=True)
+        target = torch.zeros(num_imgs * num_cells, dtype=torch.long)
+        pos = torch.randperm(len(target))[: 30 * num_imgs]
+        target[pos] = torch.randint(1, 81, (len(pos),))
+        one_hot = torch.nn.functional.one_hot(target, 81)[:, 1:]
+
+        funcs = [
+            lambda: softmax_focal_loss(pred.softmax(dim=1), target),
+            lambda: py_sigmoid_focal_loss(pred, one_hot, avg_factor=len(pos) + 1),
+            lambda: sigmoid_focal_loss(pred, target, avg_factor=len(pos) + 1),
+        ]
+        cols = []
+        for func in funcs:
+            t = timeit(lambda: func().backward(), repeat=args.repeat)
+            before = _rss_kb("VmRSS")
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            func().backward()
+            cols.append((t * 1000, (_rss_kb("VmHWM") - before) / 1024))
+        print(
+            "{:4d} | {:12.1f}, {:13.1f} | {:10.1f}, {:12.1f} | {:9.1f}, {:10.1f}".format(
+                num_imgs, *[v for col in cols for v in col]
+            )
+        )
+    # with the per-row weights of cate_neg_per_img, 200 cells per image
+    print("imgs | weighted autograd (ms, MB) | weighted fused (ms, MB)")
+    for num_imgs in (2, 8, 16, 32):
+        pred = torch.randn(num_imgs * 200, 80, requires_grad=True)
+        target = torch.zeros(num_imgs * 200, dtype=torch.long)
+        target[: 30 * num_imgs] = torch.randint(1, 81, (30 * num_imgs,))
+        weight = torch.rand(len(target)) * num_cells / 200
+        funcs = [
+            lambda: py_sigmoid_focal_loss(
+                pred,
+                torch.nn.functional.one_hot(target, 81)[:, 1:],
+                weight.view(-1, 1),
+                avg_factor=30 * num_imgs + 1,
+            ),
+            lambda: sigmoid_focal_loss(
+                pred, target, weight, avg_factor=30 * num_imgs + 1
+            ),
+        ]
+        cols = []
+        for func in funcs:
+            t = timeit(lambda: func().backward(), repeat=args.repeat)
+            before = _rss_kb("VmRSS")
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            func().backward()
+            cols.append((t * 1000, (_rss_kb("VmHWM") - before) / 1024))
+        print(
+            "{:4d} | {:17.2f}, {:6.1f} | {:14.2f}, {:6.1f}".format(
+                num_imgs, *[v for col in cols for v in col]
+            )
+        )
+
+
+def bench_sparse_kernel(args):
+    # kernel branch of SOLOv2Head (forward_single + gather_kernels) at 768x512
+    head = build_head()
+    head.init_weights()
+    num_imgs = args.batch
+    img_h, img_w = 512, 768
+    feats = [
+        torch.randn(num_imgs, 256, img_h // s, img_w // s) for s in (4, 8, 16, 32, 64)
+    ]
+    num_total = sum(g**2 for g in head.seg_num_grids)
+    print("mode  | cells/img | dense (ms) | sparse (ms) | speedup")
+    for mode, num_cells in (("train", 30), ("train", 150), ("test", 20), ("test", 200)):
+        img_cells = [
+            torch.randperm(num_total)[:num_cells].sort()[0] for _ in range(num_imgs)
+        ]
+        times = []
+        for sparse in (False, True):
+            head.sparse_kernel = sparse
+
+            def step():
+                if mode == "train":
+                    kernel_preds = head(feats, kernel_feats=sparse)[1]
+                    kernels = head.gather_kernels(kernel_preds, img_cells)
+                    torch.cat(kernels).sum().backward()
+                else:
+                    with torch.no_grad():
+                        kernel_preds = head(feats, eval=True, kernel_feats=sparse)[1]
+                        head.gather_kernels(kernel_preds, img_cells)
+
+            times.append(timeit(step, repeat=args.repeat))
+        print(
+            "{:5s} | {:9d} | {:10.1f} | {:11.1f} | {:6.2f}x".format(
+                mode, num_cells, times[0] * 1000, times[1] * 1000, times[0] / times[1]
+            )
+        )
+
+
+def bench_cate_sampling(args):
+    # loss_cate forward + backward with all cells and with sampled negatives
+    head = build_head()
+    num_cells = sum(g**2 for g in head.seg_num_grids)
+    print(
+        "imgs | negatives/img | full (ms) | sampled (ms) | speedup "
+        "| sampled / full loss (mean +- std)"
+    )
+    for num_imgs in (2, 8, 16, 32):
+        pred = torch.randn(num_imgs * num_cells, 80) - 4
+        pred[torch.randperm(len(pred))[: 10 * num_imgs]] += 4
+        pred.requires_grad_()
+        target = torch.zeros(num_imgs * num_cells, dtype=torch.long)
+        pos = torch.randperm(len(target))[: 30 * num_imgs]
+        target[pos] = torch.randint(1, 81, (len(pos),))
+        avg_factor = len(pos) + 1
+        for cate_neg_per_img in (128, 512):
+            head.cate_neg_per_img = cate_neg_per_img
+
+            def full():
+                head.loss_cate(pred, target, avg_factor=avg_factor).backward()
+
+            def sampled():
+                inds, weights = head.sample_cate_cells(pred, target, num_imgs)
+                loss = head.loss_cate(pred[inds], target[inds], weights, avg_factor)
+                loss.backward()
+                return loss.item()
+
+            t_full = timeit(full, repeat=args.repeat)
+            t_sampled = timeit(sampled, repeat=args.repeat)
+            full_loss = float(head.loss_cate(pred, target, avg_factor=avg_factor))
+            ratios = [sampled() / full_loss for _ in range(20)]
+            print(
+                "{:4d} | {:13d} | {:9.1f} | {:12.1f} | {:6.2f}x | {:.3f} +- {:.3f}".format(
+                    num_imgs,
+                    cate_neg_per_img,
+                    t_full * 1000,
+                    t_sampled * 1000,
+                    t_full / t_sampled,
+                    np.mean(ratios),
+                    np.std(ratios),
+                )
+            )
+
+
+def reference_backbone_forward(model, x):
+    """ResNet._forward_impl before frozen stages ran without autograd."""
+    x = model.maxpool(model.relu(model.bn1(model.conv1(x))))
+    outs = []
+    for i in range(1, 5):
+        x = getattr(model, "layer{}".format(i))(x)
+        outs.append(x)
+    return tuple(outs)
+
+
+def bench_frozen_stages(args):
+    # backbone forward + backward at 768x512, frozen stages with and without
+    # autograd, peak memory is measured like loss_peak_mb
+    img = torch.randn(args.batch, 3, 512, 768)
+    print("backbone | frozen_stages | forward   | peak (MB) | step (ms)")
+    for name, factory in (
+        ("resnet18", resnet18),
+        ("resnet34", resnet34),
+        ("resnet50", resnet50),
+    ):
+        for frozen_stages in (-1, 0, 1, 2):
+            model = factory(frozen_stages=frozen_stages)
+            model.train()
+            forwards = [("no_grad", model)]
+            if frozen_stages == 1:
+                forwards.insert(
+                    0, ("autograd", lambda x: reference_backbone_forward(model, x))
+                )
+            for mode, forward in forwards:
+
+                def step():
+                    outs = forward(img)
+                    sum(out.mean() for out in outs).backward()
+
+                step()
+                before = _rss_kb("VmRSS")
+                with open("/proc/self/clear_refs", "w") as f:
+                    f.write("5")
+                step()
+                peak = (_rss_kb("VmHWM") - before) / 1024
+                print(
+                    "{:8s} | {:13d} | {:9s} | {:9.0f} | {:9.0f}".format(
+                        name,
+                        frozen_stages,
+                        mode,
+                        peak,
+                        timeit(step, repeat=args.repeat) * 1000,
+                    )
+                )
+
+
+def bench_batched_inference(args):
+    # SOLOV2.forward_test at 448x672, one image per call against batches
+    # the resnet18 model eval.py runs, randomly initialised
+    model_cfg = cfg.copy({"backbone": resnet18_backbone.copy({"path": None})})
+    model = SOLOV2(model_cfg, mode="test").eval()
+    img_h, img_w = 448, 672
+    meta = dict(img_shape=(448, 650, 3), ori_shape=(480, 696, 3), scale_factor=0.93)
+    imgs = torch.randn(16, 3, img_h, img_w)
+    # randomly initialised categories score far below score_thr, lower it so
+    # the post-processing sees a few hundred candidates per image
+    with torch.no_grad():
+        cate_preds = model.bbox_head(model.extract_feat(imgs[:1]), eval=True)[0]
+    scores = torch.cat([cate_pred.reshape(-1) for cate_pred in cate_preds])
+    model.test_cfg = dict(model.test_cfg, score_thr=float(scores.topk(300)[0][-1]))
+    print("batch | per-image calls (img/s) | batched (img/s) | speedup")
+    for num_imgs in (1, 2, 4, 8, 16):
+        metas = [dict(meta) for _ in range(num_imgs)]
+
+        def single():
+            for idx in range(num_imgs):
+                model.forward_test([imgs[idx : idx + 1]], [metas[idx : idx + 1]])
+
+        def batched():
+            model.forward_test([imgs[:num_imgs]], [metas])
+
+        with torch.no_grad():
+            t_single = timeit(single, repeat=args.repeat)
+            t_batched = timeit(batched, repeat=args.repeat)
+        print(
+            "{:5d} | {:23.2f} | {:15.2f} | {:6.2f}x".format(
+                num_imgs,
+                num_imgs / t_single,
+                num_imgs / t_batched,
+                t_single / t_batched,
+            )
+        )
+    # get_seg alone with 500 candidates per image, its peak memory should not
+    # grow with the batch
+    head = build_head()
+    head.init_weights()
+    cate_preds, kernel_preds, seg_pred, test_cfg = seg_inputs(
+        head, 16, img_h, img_w, num_cands=500
+    )
+    test_cfg["nms_pre"] = 500
+    print("batch | get_seg per image (ms) | peak (MB)")
+    for num_imgs in (1, 4, 16):
+        inputs = (
+            [cate_pred[:num_imgs] for cate_pred in cate_preds],
+            [kernel_pred[:num_imgs] for kernel_pred in kernel_preds],
+            seg_pred[:num_imgs],
+            [dict(meta) for _ in range(num_imgs)],
+        )
+
+        def get_seg():
+            with torch.no_grad():
+                return head.get_seg(*inputs, test_cfg)
+
+        t_seg = timeit(get_seg, repeat=args.repeat)
+        before = _rss_kb("VmRSS")
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        get_seg()
+        peak = (_rss_kb("VmHWM") - before) / 1024
+        print(
+            "{:5d} | {:22.1f} | {:9.0f}".format(num_imgs, t_seg * 1000 / num_imgs, peak)
+        )
+
+
+def seg_inputs(head, num_imgs, img_h, img_w, num_cands=300):
+    """Random get_seg inputs and a test config passing about ``num_cands``
+    candidates of the first image."""
+    feats = [
+        torch.randn(num_imgs, 256, img_h // s, img_w // s) for s in (4, 8, 16, 32, 64)
+    ]
+    seg_pred = torch.randn(num_imgs, 128, img_h // 4, img_w // 4)
+    with torch.no_grad():
+        cate_preds, kernel_preds = head(feats, eval=True)
+    scores = torch.cat([cate_pred[0].reshape(-1) for cate_pred in cate_preds])
+    test_cfg = dict(
+        cfg.test_cfg, score_thr=float(scores.topk(num_cands)[0][-1]), update_thr=0.0
+    )
+    return cate_preds, kernel_preds, seg_pred, test_cfg
+
+
+def bench_lazy_masks(args):
+    # get_seg of a 1080p frame (resized to 448x797) with 30 instances
+    head = build_head()
+    head.init_weights()
+    cate_preds, kernel_preds, seg_pred, test_cfg = seg_inputs(head, 1, 448, 800)
+    img_metas = [dict(img_shape=(448, 797, 3), ori_shape=(1080, 1920, 3))]
+    print("mask_format | get_seg (ms) | peak (MB) | first 3 masks (ms)")
+    for mask_format in ("dense", "lazy"):
+        test_cfg["mask_format"] = mask_format
+
+        def get_seg():
+            with torch.no_grad():
+                return head.get_seg(
+                    cate_preds, kernel_preds, seg_pred, img_metas, test_cfg
+                )
+
+        t_seg = timeit(get_seg, repeat=args.repeat)
+        before = _rss_kb("VmRSS")
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        seg_masks = get_seg()[0][0]
+        peak = (_rss_kb("VmHWM") - before) / 1024
+        start = time.perf_counter()
+        for idx in range(3):
+            seg_masks[idx]
+        t_access = time.perf_counter() - start
+        print(
+            "{:11s} | {:12.1f} | {:9.0f} | {:18.1f}".format(
+                mask_format, t_seg * 1000, peak, t_access * 1000
+            )
+        )
+        del seg_masks
+
+
+def bench_mask_upsampling(args):
+    # final stage of get_seg for a 1080p frame (448x797 in a 448x800 input):
+    # whole-frame against box-cropped upsampling of 30 blob-shaped soft masks
+    low_h, low_w = 112, 200
+    ys = torch.arange(low_h, dtype=torch.float32).view(-1, 1)
+    xs = torch.arange(low_w, dtype=torch.float32).view(1, -1)
+    torch.manual_seed(0)
+    print(
+        "instance area | dense (ms) | cropped (ms) | dense peak (MB) "
+        "| cropped peak (MB) | differing pixels"
+    )
+    for frac in (0.005, 0.02, 0.1):
+        radius = (frac * low_h * low_w / 3.14) ** 0.5
+        centers = torch.rand(30, 2) * torch.tensor([low_h, low_w])
+        dist = (ys - centers[:, 0].view(-1, 1, 1)) ** 2 + (
+            xs - centers[:, 1].view(-1, 1, 1)
+        ) ** 2
+        soft_masks = torch.sigmoid(2 * (radius - dist.sqrt()))
+        seg_masks = LazySegMasks(
+            soft_masks, (448, 800), (448, 797), (1080, 1920), mask_thr=0.5
+        )
+        results = []
+        for func in (
+            lambda: seg_masks.upsample(soft_masks),
+            lambda: crop_upsample(
+                soft_masks, (448, 800), (448, 797), (1080, 1920), 0.5
+            ),
+        ):
+            t = timeit(func, repeat=args.repeat)
+            before = _rss_kb("VmRSS")
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            out = func()
+            results.append((t, (_rss_kb("VmHWM") - before) / 1024, out))
+        diff = crop_difference(results[0][2], *results[1][2])
+        print(
+            "{:12.1f}% | {:10.1f} | {:12.1f} | {:15.0f} | {:17.0f} | {:d}".format(
+                frac * 100,
+                results[0][0] * 1000,
+                results[1][0] * 1000,
+                results[0][1],
+                results[1][1],
+                diff,
+            )
+        )
+    # foreground only in the padded rows or columns past img_shape reaches
+    # no output pixel and gives an empty crop
+    soft_masks = torch.zeros(3, 112, 168)
+    soft_masks[0, -4:, 20:40] = 0.9
+    soft_masks[1, 10:30, -5:] = 0.9
+    soft_masks[2, 40:60, 50:70] = 0.9
+    shapes = ((448, 672), (430, 640, 3), (645, 960, 3))
+    dense = LazySegMasks(soft_masks, *shapes, mask_thr=0.5).upsample(soft_masks)
+    crops, offsets = crop_upsample(soft_masks, *shapes, 0.5)
+    print(
+        "foreground in the padding only: differing pixels {:d}".format(
+            crop_difference(dense, crops, offsets)
+        )
+    )
+
+
+def crop_difference(dense, crops, offsets):
+    """Pixels where box-cropped masks differ from the full size ones."""
+    diff = 0
+    for idx, crop in enumerate(crops):
+        y, x = offsets[idx].tolist()
+        region = dense[idx, y : y + crop.size(0), x : x + crop.size(1)]
+        diff += int((region != crop).sum()) + int(dense[idx].sum() - region.sum())
+    return diff
+
+
+def boundary_iou(masks_a, masks_b, dilation_ratio=0.02):
+    """Boundary IoU of two stacks of bool masks over all instances, the
+    boundary being the pixels within 2% of the image diagonal of the contour."""
+    h, w = masks_a.shape[-2:]
+    dilation = max(1, int(round(dilation_ratio * (h**2 + w**2) ** 0.5)))
+    kernel = np.ones((3, 3), dtype=np.uint8)
+    inter = union = 0
+    for mask_a, mask_b in zip(masks_a.numpy(), masks_b.numpy()):
+        bounds = []
+        for mask in (mask_a, mask_b):
+            mask = mask.astype(np.uint8)
+            padded = cv2.copyMakeBorder(mask, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+            eroded = cv2.erode(padded, kernel, iterations=dilation)[1:-1, 1:-1]
+            bounds.append((mask - eroded).astype(bool))
+        inter += int((bounds[0] & bounds[1]).sum())
+        union += int((bounds[0] | bounds[1]).sum())
+    return inter / max(union, 1)
+
+
+def blob_masks(num_masks, height, width, max_radius):
+    """Random disc-shaped bool masks."""
+    ys = torch.arange(height, dtype=torch.float32).view(-1, 1)
+    xs = torch.arange(width, dtype=torch.float32).view(1, -1)
+    centers = torch.rand(num_masks, 2) * torch.tensor([height, width])
+    radius = torch.rand(num_masks) * (max_radius - 2) + 2
+    dist = (ys - centers[:, 0].view(-1, 1, 1)) ** 2 + (
+        xs - centers[:, 1].view(-1, 1, 1)
+    ) ** 2
+    return dist < radius.view(-1, 1, 1) ** 2
+
+
+def bench_matrix_nms(args):
+    # Matrix NMS on stride-4 masks of a 448x800 input, 20 classes
+    torch.manual_seed(0)
+    print("n    | dense (ms) | tiled (ms) | dense peak (MB) | tiled peak (MB) | equal")
+    for num_masks in (100, 250, 500, 1000, 2000):
+        seg_masks = blob_masks(num_masks, 112, 200, 40)
+        sum_masks = seg_masks.sum((1, 2)).float()
+        cate_labels = torch.randint(0, 20, (num_masks,))
+        cate_scores = torch.rand(num_masks).sort(descending=True)[0]
+        results = []
+        for nms, kwargs in ((matrix_nms, {}), (matrix_nms_tiled, dict(block_size=256))):
+
+            def func():
+                return nms(
+                    seg_masks, cate_labels, cate_scores, sum_masks=sum_masks, **kwargs
+                )
+
+            t = timeit(func, repeat=args.repeat)
+            before = _rss_kb("VmRSS")
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            out = func()
+            results.append((t, (_rss_kb("VmHWM") - before) / 1024, out))
+        print(
+            "{:4d} | {:10.1f} | {:10.1f} | {:15.0f} | {:15.0f} | {}".format(
+                num_masks,
+                results[0][0] * 1000,
+                results[1][0] * 1000,
+                results[0][1],
+                results[1][1],
+                torch.equal(results[0][2], results[1][2]),
+            )
+        )
+
+
+def bench_matrix_nms_sparse(args):
+    # Matrix NMS on stride-4 masks of a 448x800 input, 80 classes
+    torch.manual_seed(0)
+    print(
+        "n    | labels  | sum(n_k^2) / n^2 | dense (ms) | per-class (ms) | speedup | equal"
+    )
+    for num_masks in (100, 250, 500, 1000, 2000):
+        seg_masks = blob_masks(num_masks, 112, 200, 40)
+        sum_masks = seg_masks.sum((1, 2)).float()
+        cate_scores = torch.rand(num_masks).sort(descending=True)[0]
+        # uniform, and a third of the candidates in one class like person
+        for name, probs in (
+            ("uniform", torch.ones(80)),
+            ("skewed", torch.cat([torch.tensor([40.0]), torch.ones(79)])),
+        ):
+            cate_labels = torch.multinomial(probs, num_masks, replacement=True)
+            counts = torch.bincount(cate_labels).double()
+            times, outs = [], []
+            for nms in (matrix_nms, matrix_nms_sparse):
+
+                def func():
+                    return nms(seg_masks, cate_labels, cate_scores, sum_masks=sum_masks)
+
+                times.append(timeit(func, repeat=args.repeat))
+                outs.append(func())
+            print(
+                "{:4d} | {:7s} | {:16.3f} | {:10.1f} | {:14.1f} | {:6.2f}x | {}".format(
+                    num_masks,
+                    name,
+                    float((counts**2).sum()) / num_masks**2,
+                    times[0] * 1000,
+                    times[1] * 1000,
+                    times[0] / times[1],
+                    torch.equal(outs[0], outs[1]),
+                )
+            )
+
+
+def bench_kernel_cap(args):
+    # get_seg on casia-SPT_val (448 short side) with max_kernels_before_conv,
+    # randomly initialised resnet18 model with score_thr lowered to give a
+    # busy ~3000 candidates per image
+    dataset = casia_dataset(
+        [
+            dict(type="LoadImageFromFile"),
+            dict(type="Resize", img_scale=(768, 448), keep_ratio=True),
+            dict(type="RandomFlip", flip_ratio=0),
+            dict(
+                type="Normalize",
+                mean=[123.675, 116.28, 103.53],
+                std=[58.395, 57.12, 57.375],
+                to_rgb=True,
+            ),
+            dict(type="Pad", size_divisor=32),
+            dict(type="ImageToTensor", keys=["img"]),
+            dict(type="Collect", keys=["img"]),
+        ]
+    )
+    model_cfg = cfg.copy({"backbone": resnet18_backbone.copy({"path": None})})
+    model = SOLOV2(model_cfg, mode="test").eval()
+    head = model.bbox_head
+    outs = []
+    with torch.no_grad():
+        for idx in range(20):
+            data = dataset[idx]
+            x = model.extract_feat(data["img"][None])
+            mask_feat = model.mask_feat_head(
+                x[model.mask_feat_head.start_level : model.mask_feat_head.end_level + 1]
+            )
+            outs.append(head(x, eval=True) + (mask_feat, [data["img_metas"].data]))
+    scores = torch.cat([cate_pred.reshape(-1) for cate_pred in outs[0][0]])
+    test_cfg = dict(
+        model.test_cfg, score_thr=float(scores.topk(3000)[0][-1]), update_thr=0.0
+    )
+    num_cands = np.mean(
+        [sum(int((p > test_cfg["score_thr"]).sum()) for p in out[0]) for out in outs]
+    )
+    print("{} images, {:.0f} candidates per image".format(len(outs), num_cands))
+    print("max_kernels_before_conv | get_seg (ms/img) | detections kept")
+    reference = None
+    for max_kernels in (None, 1000, 500, 250, 100):
+        test_cfg["max_kernels_before_conv"] = max_kernels
+        results = []
+
+        def run():
+            del results[:]
+            with torch.no_grad():
+                for out in outs:
+                    results.append(head.get_seg(*out, test_cfg)[0])
+
+        t = timeit(run, repeat=args.repeat)
+        dets = [
+            (
+                set()
+                if result is None
+                else set(zip(result[1].tolist(), result[2].mul(1e6).round().tolist()))
+            )
+            for result in results
+        ]
+        if reference is None:
+            reference = dets
+        kept = np.mean(
+            [len(d & r) / len(r) if r else 1.0 for d, r in zip(dets, reference)]
+        )
+        print(
+            "{:>23} | {:16.1f} | {:14.1%}".format(
+                str(max_kernels), t * 1000 / len(outs), kept
+            )
+        )
+
+
+def bench_mask_chunk(args):
+    # get_seg of one 448x672 image with all masks at once against mask_chunk
+    head = build_head()
+    head.init_weights()
+    img_metas = [dict(img_shape=(448, 650, 3), ori_shape=(480, 696, 3))]
+    print("candidates | mask_chunk | get_seg (ms) | peak (MB)")
+    for num_cands in (500, 1000, 2000, 4000):
+        cate_preds, kernel_preds, seg_pred, test_cfg = seg_inputs(
+            head, 1, 448, 672, num_cands=num_cands
+        )
+        for mask_chunk in (None, 64):
+            test_cfg["mask_chunk"] = mask_chunk
+
+            def get_seg():
+                with torch.no_grad():
+                    return head.get_seg(
+                        cate_preds, kernel_preds, seg_pred, img_metas, test_cfg
+                    )
+
+            t = timeit(get_seg, repeat=args.repeat)
+            before = _rss_kb("VmRSS")
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            get_seg()
+            print(
+                "{:10d} | {:>10} | {:12.1f} | {:9.0f}".format(
+                    num_cands,
+                    str(mask_chunk),
+                    t * 1000,
+                    (_rss_kb("VmHWM") - before) / 1024,
+                )
+            )
+
+
+def reference_rles(masks):
+    """COCO RLEs as eval.py encoded them before, one pycocotools call per
+    instance."""
+    seg_pred = masks.cpu().numpy().astype(np.uint8)
+    return [mask_util.encode(np.asfortranarray(mask)) for mask in seg_pred]
+
+
+def bench_rle(args):
+    # COCO RLE export of 100 instances of a 1080p frame
+    torch.manual_seed(0)
+    print("max radius | pycocotools (ms) | dense (ms) | cropped (ms) | identical")
+    for max_radius in (50, 200, 500):
+        masks = blob_masks(100, 1080, 1920, max_radius)
+        crops, offsets = [], torch.zeros((len(masks), 2), dtype=torch.long)
+        for idx, mask in enumerate(masks):
+            ys = mask.any(1).nonzero().flatten()
+            xs = mask.any(0).nonzero().flatten()
+            y0, y1, x0, x1 = int(ys[0]), int(ys[-1]) + 1, int(xs[0]), int(xs[-1]) + 1
+            crops.append(mask[y0:y1, x0:x1].clone())
+            offsets[idx] = torch.tensor([y0, x0])
+        cropped = CroppedSegMasks(crops, offsets, (1080, 1920))
+        funcs = (
+            lambda: reference_rles(masks),
+            lambda: encode_masks(masks),
+            lambda: encode_masks(cropped),
+        )
+        times = [timeit(func, repeat=args.repeat) for func in funcs]
+        ref, dense, crop = [func() for func in funcs]
+        identical = all(
+            r["counts"] == d["counts"] == c["counts"] and r["size"] == d["size"]
+            for r, d, c in zip(ref, dense, crop)
+        )
+        print(
+            "{:10d} | {:16.1f} | {:10.1f} | {:12.1f} | {}".format(
+                max_radius, times[0] * 1000, times[1] * 1000, times[2] * 1000, identical
+            )
+        )
+
+
+def export_json(rles, scores):
+    """COCO results of one image as eval.py's result2json writes them."""
+    results = []
+    for rle, score in zip(rles, scores.tolist()):
+        rle["counts"] = rle["counts"].decode("ascii")
+        results.append(
+            dict(image_id=0, category_id=1, score=float(score), segmentation=rle)
+        )
+    return json.dumps(results)
+
+
+def boundary_error(masks, rles):
+    """Pixels of the decoded RLEs differing from masks, and their largest
+    distance to a pixel of masks with the value they were given."""
+    decoded = mask_util.decode(rles).transpose(2, 0, 1)
+    masks = masks.numpy().astype(np.uint8)
+    num_diff, max_dist = 0, 0.0
+    for mask, out in zip(masks, decoded):
+        diff = mask != out
+        if not diff.any():
+            continue
+        num_diff += int(diff.sum())
+        # distance of every pixel to the nearest one of the other value
+        for value in (0, 1):
+            wrong = diff & (out == value)
+            if wrong.any():
+                dist = cv2.distanceTransform(
+                    (mask != value).astype(np.uint8), cv2.DIST_L2, 5
+                )
+                max_dist = max(max_dist, float(dist[wrong].max()))
+    return num_diff, max_dist
+
+
+def bench_rle_upscaling(args):
+    # post-processing of get_seg to COCO JSON for 100 blob instances of a
+    # 1080p frame (448x797 in a 448x800 input)
+    low_h, low_w = 112, 200
+    ys = torch.arange(low_h, dtype=torch.float32).view(-1, 1)
+    xs = torch.arange(low_w, dtype=torch.float32).view(1, -1)
+    torch.manual_seed(0)
+    scores = torch.rand(100)
+    print(
+        "instance area | upsample + pycocotools (ms) | upsample + rle (ms) "
+        "| lazy refined (ms) | lazy runs (ms) | refined diff px | runs diff px "
+        "| runs max dist (px)"
+    )
+    for frac in (0.002, 0.01, 0.05):
+        radius = (frac * low_h * low_w / 3.14) ** 0.5
+        centers = torch.rand(100, 2) * torch.tensor([low_h, low_w])
+        dist = (ys - centers[:, 0].view(-1, 1, 1)) ** 2 + (
+            xs - centers[:, 1].view(-1, 1, 1)
+        ) ** 2
+        soft_masks = torch.sigmoid(2 * (radius - dist.sqrt()))
+        seg_masks = LazySegMasks(
+            soft_masks, (448, 800), (448, 797), (1080, 1920), mask_thr=0.5
+        )
+        funcs = (
+            lambda: export_json(reference_rles(seg_masks.upsample(soft_masks)), scores),
+            lambda: export_json(encode_masks(seg_masks.upsample(soft_masks)), scores),
+            lambda: export_json(encode_masks(seg_masks), scores),
+            lambda: export_json(encode_masks(seg_masks, refine=False), scores),
+        )
+        times = [timeit(func, repeat=args.repeat) for func in funcs]
+        dense = seg_masks.upsample(soft_masks)
+        refined = boundary_error(dense, encode_masks(seg_masks))
+        runs = boundary_error(dense, encode_masks(seg_masks, refine=False))
+        print(
+            "{:12.1f}% | {:27.1f} | {:19.1f} | {:17.1f} | {:14.1f} | {:15d} "
+            "| {:12d} | {:18.1f}".format(
+                frac * 100, *[t * 1000 for t in times], refined[0], runs[0], runs[1]
+            )
+        )
+
+
+def bench_mask_band(args):
+    # final stage of get_seg for a 1080p frame (448x797 in a 448x800 input):
+    # whole-frame against boundary-band upsampling of 30 blob-shaped masks
+    low_h, low_w = 112, 200
+    ys = torch.arange(low_h, dtype=torch.float32).view(-1, 1)
+    xs = torch.arange(low_w, dtype=torch.float32).view(1, -1)
+    torch.manual_seed(0)
+    print("instance area | dense (ms) | band (ms) | differing pixels | boundary IoU")
+    for frac in (0.005, 0.02, 0.1):
+        radius = (frac * low_h * low_w / 3.14) ** 0.5
+        centers = torch.rand(30, 2) * torch.tensor([low_h, low_w])
+        dist = (ys - centers[:, 0].view(-1, 1, 1)) ** 2 + (
+            xs - centers[:, 1].view(-1, 1, 1)
+        ) ** 2
+        soft_masks = torch.sigmoid(2 * (radius - dist.sqrt()))
+        seg_masks = LazySegMasks(
+            soft_masks, (448, 800), (448, 797), (1080, 1920), mask_thr=0.5
+        )
+        funcs = (
+            lambda: seg_masks.upsample(soft_masks),
+            lambda: band_upsample(
+                soft_masks, (448, 800), (448, 797), (1080, 1920), 0.5
+            ),
+        )
+        times = [timeit(func, repeat=args.repeat) for func in funcs]
+        dense, band = [func() for func in funcs]
+        print(
+            "{:12.1f}% | {:10.1f} | {:9.1f} | {:16d} | {:12.4f}".format(
+                frac * 100,
+                times[0] * 1000,
+                times[1] * 1000,
+                int((dense != band).sum()),
+                boundary_iou(dense, band),
+            )
+        )
+
+
+def bench_coord_conv(args):
+    # SOLOv2Head and MaskFeatHead at inference on the FPN levels of a 448x800
+    # input, coordinates concatenated against folded into a cached bias. The
+    # two variants run interleaved and the medians are reported, the saved
+    # work is small next to the convs
+    torch.manual_seed(0)
+    feats = [
+        torch.randn(args.batch, 256, 448 // s, 800 // s) for s in (4, 8, 16, 32, 64)
+    ]
+    forwards = []
+    for fold in (False, True):
+        torch.manual_seed(0)
+        head = build_head(fold_coord_conv=fold)
+        head.init_weights()
+        mask_head = MaskFeatHead(256, 128, 0, 3, 128, fold_coord_conv=fold)
+        mask_head.init_weights()
+        head.eval()
+        mask_head.eval()
+
+        def forward(head=head, mask_head=mask_head):
+            with torch.no_grad():
+                cate_preds, kernel_preds = head(feats, eval=True)
+                return list(cate_preds) + list(kernel_preds) + [mask_head(feats[:4])]
+
+        forwards.append(forward)
+    outputs = [forward() for forward in forwards]
+    diff = max(float((a - b).abs().max()) for a, b in zip(*outputs))
+    times = [[], []]
+    for _ in range(args.repeat):
+        for forward, forward_times in zip(forwards, times):
+            start = time.perf_counter()
+            forward()
+            forward_times.append(time.perf_counter() - start)
+    print("coordinates  | heads (ms) | peak (MB)")
+    for name, forward, forward_times in zip(
+        ("concatenated", "folded"), forwards, times
+    ):
+        before = _rss_kb("VmRSS")
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        forward()
+        peak = (_rss_kb("VmHWM") - before) / 1024
+        print(
+            "{:12s} | {:10.1f} | {:9.0f}".format(
+                name, sorted(forward_times)[len(forward_times) // 2] * 1000, peak
+            )
+        )
+    print("max abs difference: {:.2e}".format(diff))
+
+
+def latency_histogram(times, bins):
+    """Text histogram of per-frame latencies (s) over bin edges (ms)."""
+    counts, _ = np.histogram(np.asarray(times) * 1000, bins=bins)
+    return [
+        "{:5.0f}-{:<5.0f} {:4d} {}".format(lo, hi, count, "#" * count)
+        for lo, hi, count in zip(bins[:-1], bins[1:], counts)
+    ]
+
+
+def bench_early_exit(args):
+    # SOLOV2.forward_test on a static scene video: a fixed background with
+    # per-frame sensor noise, 448x608, the randomly initialised resnet18
+    # model. The frames run with and without test_cfg cate_first,
+    # interleaved. With score_thr=0.1 no cell of such a frame passes; the
+    # "busy" pass lowers score_thr and update_thr so every frame has about
+    # 300 candidates and detections, which shows the cost of running the
+    # category branch on its own first
+    model_cfg = cfg.copy({"backbone": resnet18_backbone.copy({"path": None})})
+    torch.manual_seed(0)
+    model = SOLOV2(model_cfg, mode="test").eval()
+    rng = np.random.RandomState(0)
+    background = cv2.GaussianBlur(rng.randn(448, 608, 3).astype(np.float32), (0, 0), 8)
+    background = torch.from_numpy(background * 20).permute(2, 0, 1)[None]
+    num_frames = args.repeat * 4
+    frames = [
+        background + 0.05 * torch.randn_like(background) for _ in range(num_frames)
+    ]
+    meta = dict(img_shape=(448, 597, 3), ori_shape=(480, 640, 3), scale_factor=0.93)
+    with torch.no_grad():
+        cate_preds = model.bbox_head(model.extract_feat(frames[0]), eval=True)[0]
+    scores = torch.cat([cate_pred.reshape(-1) for cate_pred in cate_preds])
+    busy_thr = float(scores.topk(300)[0][-1])
+    print("max category score of a frame: {:.4f}".format(float(scores.max())))
+    scenes = (
+        ("static", dict(model.test_cfg)),
+        ("busy", dict(model.test_cfg, score_thr=busy_thr, update_thr=0.0)),
+    )
+    for scene, scene_cfg in scenes:
+        test_cfgs = [
+            dict(scene_cfg, cate_first=cate_first) for cate_first in (False, True)
+        ]
+        times = [[], []]
+        results = [[], []]
+        with torch.no_grad():
+            for frame in frames:
+                for test_cfg, frame_times, frame_results in zip(
+                    test_cfgs, times, results
+                ):
+                    model.test_cfg = test_cfg
+                    start = time.perf_counter()
+                    result = model.forward_test([frame], [[dict(meta)]])[0]
+                    frame_times.append(time.perf_counter() - start)
+                    frame_results.append(result)
+        same = all(
+            (a is None and b is None)
+            or (
+                a is not None
+                and b is not None
+                and all(torch.equal(x, y) for x, y in zip(a, b))
+            )
+            for a, b in zip(*results)
+        )
+        empty = sum(result is None for result in results[1])
+        print(
+            "\n{} scene, score_thr {:.4f}: {} of {} frames empty, same results: {}".format(
+                scene, scene_cfg["score_thr"], empty, num_frames, same
+            )
+        )
+        bins = np.linspace(
+            np.floor(min(map(min, times)) * 100) * 10,
+            np.ceil(max(map(max, times)) * 100) * 10,
+            11,
+        )
+        for name, frame_times in zip(("full", "cate_first"), times):
+            print(
+                "{}: median {:.1f} ms, p90 {:.1f} ms".format(
+                    name,
+                    np.median(frame_times) * 1000,
+                    np.percentile(frame_times, 90) * 1000,
+                )
+            )
+            for line in latency_histogram(frame_times, bins):
+                print("  " + line)
+
+
+def bench_levels(args):
+    # SOLOV2.forward_test at 448x608 with test_cfg levels, the randomly
+    # initialised resnet18 model, score_thr and update_thr lowered so all
+    # levels together pass about 300 candidates. The level sets run
+    # interleaved; the cells are those of the levels kept
+    model_cfg = cfg.copy({"backbone": resnet18_backbone.copy({"path": None})})
+    torch.manual_seed(0)
+    model = SOLOV2(model_cfg, mode="test").eval()
+    imgs = torch.randn(args.batch, 3, 448, 608)
+    metas = [
+        dict(img_shape=(448, 597, 3), ori_shape=(480, 640, 3), scale_factor=0.93)
+        for _ in range(args.batch)
+    ]
+    with torch.no_grad():
+        cate_preds = model.bbox_head(model.extract_feat(imgs[:1]), eval=True)[0]
+    scores = torch.cat([cate_pred.reshape(-1) for cate_pred in cate_preds])
+    base_cfg = dict(
+        model.test_cfg, score_thr=float(scores.topk(300)[0][-1]), update_thr=0.0
+    )
+    level_sets = [None, (1, 2, 3, 4), (2, 3, 4), (3, 4)]
+    times = [[] for _ in level_sets]
+    with torch.no_grad():
+        for _ in range(args.repeat):
+            for levels, level_times in zip(level_sets, times):
+                model.test_cfg = dict(base_cfg, levels=levels)
+                start = time.perf_counter()
+                model.forward_test([imgs], [metas])
+                level_times.append(time.perf_counter() - start)
+    grids = model.bbox_head.seg_num_grids
+    print("levels       | cells | forward_test (ms)")
+    for levels, level_times in zip(level_sets, times):
+        if levels is None:
+            levels = range(len(grids))
+        print(
+            "{:12s} | {:5d} | {:17.1f}".format(
+                ",".join(map(str, levels)),
+                sum(grids[idx] ** 2 for idx in levels),
+                np.median(level_times) * 1000,
+            )
+        )
+
+
+BENCHMARKS = {
+    "targets": bench_targets,
+    "dynamic_conv": bench_dynamic_conv,
+    "ins_loss_memory": bench_ins_loss_memory,
+    "focal_loss": bench_focal_loss,
+    "sparse_kernel": bench_sparse_kernel,
+    "cate_sampling": bench_cate_sampling,
+    "frozen_stages": bench_frozen_stages,
+    "batched_inference": bench_batched_inference,
+    "lazy_masks": bench_lazy_masks,
+    "mask_upsampling": bench_mask_upsampling,
+    "matrix_nms": bench_matrix_nms,
+    "matrix_nms_sparse": bench_matrix_nms_sparse,
+    "kernel_cap": bench_kernel_cap,
+    "mask_chunk": bench_mask_chunk,
+    "rle": bench_rle,
+    "rle_upscaling": bench_rle_upscaling,
+    "mask_band": bench_mask_band,
+    "coord_conv": bench_coord_conv,
+    "early_exit": bench_early_exit,
+    "levels": bench_levels,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SOLOv2 micro benchmarks")
+    parser.add_argument("name", choices=sorted(BENCHMARKS))
+    parser.add_argument("--repeat", default=5, type=int)
+    parser.add_argument("--threads", default=None, type=int)
+    parser.add_argument("--batch", default=2, type=int)
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    BENCHMARKS[args.name](args)
@@ -10,6 +10,17 @@ from torch.nn.utils import clip_grad
 
 torch.autograd.set_detect_anomaly(True)
 
+# keys added by the SOLOv2Target pipeline
+SOLOV2_TARGET_KEYS = (
+    "ins_labels",
+    "cate_labels",
+    "ins_ind_labels",
+    "grid_orders",
+    "ins_indices",
+    "gt_centers",
+    "gt_areas",
+)
+
 
 # 梯度均衡
 def clip_grads(params):
@@ -98,7 +109,7 @@ def train(epoch_iters=1, total_epochs=36):
     for i, data in enumerate(train_data_loader):
         print("data:", data.keys())
         # print(data["gt_masks"][0].shape)
-        print(len(data["gt_masks"]))
+        print(len(data["gt_bboxes"]))
         break
 
     # exit()
@@ -209,7 +220,12 @@ def train(epoch_iters=1, total_epochs=36):
                     bbox = gradinator(bbox.cuda())
                     gt_bboxes.append(bbox)
 
-                gt_masks = data["gt_masks"].data[0]  # cpu numpy data
+                # cpu numpy data, only collected without the SOLOv2Target pipeline
+                gt_masks = data["gt_masks"].data[0] if "gt_masks" in data else None
+                gt_targets = None
+                if "ins_labels" in data:
+                    # targets from the loader workers, the head moves them to the gpu
+                    gt_targets = {key: data[key].data[0] for key in SOLOV2_TARGET_KEYS}
 
                 gt_labels = []
                 for label in data["gt_labels"].data[0]:
@@ -222,6 +238,7 @@ def train(epoch_iters=1, total_epochs=36):
                     gt_bboxes=gt_bboxes,
                     gt_labels=gt_labels,
                     gt_masks=gt_masks,
+                    gt_targets=gt_targets,
                 )
 
                 losses = loss["loss_ins"] + loss["loss_cate"]